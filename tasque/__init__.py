@@ -8,6 +8,8 @@ from . import db
 from . import cuda_selector
 from . import resources
 from . import utils
+from . import wrapper
+from . import forkserver
 from . import daemon
 from . import client
 from . import cli
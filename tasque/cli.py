@@ -25,12 +25,56 @@ def shorthand_task_add(argv):
     ag = argparse.ArgumentParser()
     ag.add_argument('-p', '--pri', type=int, default=0,
             help='priority of the given task')
-    ag.add_argument('-r', '--rsc', type=float, default=0,
-            help='resource to allocate for the given task')
+    ag.add_argument('-r', '--rsc', type=float, default=None,
+            help='resource to allocate for the given task (default: 0)')
+    ag.add_argument('--cpu', type=float, default=None,
+            help='number of CPU cores (multi-resource request)')
+    ag.add_argument('--mem', type=float, default=None,
+            help='memory in MB (multi-resource request)')
+    ag.add_argument('--gpu', type=float, default=None,
+            help='number of GPU cards (multi-resource request)')
+    ag.add_argument('--vmem', type=float, default=None,
+            help='video memory in MB (multi-resource request)')
+    ag.add_argument('--auto-rsc', action='store_true',
+            help='estimate the resource request from similar past tasks')
+    ag.add_argument('--python', type=str, default=None, metavar='MODULE:FUNC',
+            help='python task: call MODULE:FUNC in a warm template process,'
+            + ' with the command line as sys.argv[1:]')
+    ag.add_argument('--retry', type=int, default=None, metavar='N',
+            help='run the task up to N times in total until it succeeds')
+    ag.add_argument('--retry-backoff', type=float, default=None, metavar='SEC',
+            help='seconds to wait before the first retry (doubling)')
+    ag.add_argument('--retry-on', type=str, default=None, metavar='CODES',
+            help='comma-separated exit codes to retry on (default: any'
+            + ' positive one); negative ones are signals, e.g. -9')
+    ag.add_argument('--retry-pattern', type=str, default=None, metavar='REGEX',
+            help='only retry if the output of the task matches REGEX')
+    ag.add_argument('--memo', type=str, action='append', default=None,
+            metavar='GLOB', help='memoize the result of the task, with GLOB'
+            + ' (repeatable) as its input files: an earlier successful run'
+            + ' with the same inputs completes it')
+    ag.add_argument('--memo-env', type=str, action='append', default=None,
+            metavar='VAR', help='memoize the result of the task, with VAR'
+            + ' (repeatable) as an environment variable it depends on')
     ag = ag.parse_args(argv[:argv.index('--')])
+    retry = defs.Retry(None, ag.retry, ag.retry_backoff, ag.retry_on,
+            ag.retry_pattern)
+    retry = None if retry == defs.Retry(*[None] * 5) else retry
+    memo = None if ag.memo is None and ag.memo_env is None else \
+            {'inputs': ag.memo or [], 'env': ag.memo_env or []}
+    rscv = {kind: v for (kind, v) in (('cpu', ag.cpu), ('memory', ag.mem),
+            ('gpu', ag.gpu), ('vmem', ag.vmem)) if v is not None}
     # parse cmd
     cmd = ' '.join(argv[argv.index('--')+1:])
-    client.enqueue(cwd=cwd, cmd=cmd, pri=ag.pri, rsc=ag.rsc)
+    if ag.python is not None:
+        if ':' not in ag.python:
+            raise ValueError('--python expects MODULE:FUNC')
+        cmd = ' '.join([ag.python, cmd]).strip()
+    # (unless it is to be estimated)
+    rsc = 0 if ag.rsc is None and not ag.auto_rsc else ag.rsc
+    client.enqueue(cwd=cwd, cmd=cmd, pri=ag.pri, rsc=rsc, rscv=rscv,
+            auto_rsc=ag.auto_rsc, entry=ag.python, env=dict(os.environ),
+            retry=retry, memo=memo)
 
 def task(argv):
     client = tqClient()
@@ -68,7 +112,22 @@ def config(argv):
 
 def ls(argv):
     client = tqClient()
-    client.tqls()
+    client.tqls(archive='--archive' in argv)
+
+def stats(argv):
+    client = tqClient()
+    client.stats(archive='--archive' in argv)
+
+def tail(argv):
+    client = tqClient()
+    ag = argparse.ArgumentParser(prog='tq tail')
+    ag.add_argument('-f', '--follow', action='store_true',
+            help='keep printing the output until the task finishes')
+    ag.add_argument('-n', '--lines', type=int, default=10,
+            help='number of trailing lines to print first')
+    ag.add_argument('id', type=int, help='task id')
+    ag = ag.parse_args(argv)
+    client.tail(ag.id, lines=ag.lines, follow=ag.follow)
 
 def dump(argv):
     client = tqClient()
@@ -114,11 +173,14 @@ def usage():
     USAGE = f'''
 Usage: tq <subcommand> \[action] \[arguments]
        tq \[specifiers] -- <command-line-to-submit>
+       tq \[specifiers] --python <module:func> -- <arguments>
 Subcommands:
        d|daemon        Manage the daemon/scheduler (e.g. start/stop)
        t|task          Manage tasks (e.g. add/delete/clear)
        a|annotate      Manage task annotations (e.g. add/delete)
-       l|ls|list       List task queue
+       l|ls|list       List task queue (--archive for finished history)
+       stats           Task statistics (--archive for finished history)
+       tail            Print task output (-f to follow a running task)
        c|config        Config daemon
        log             Dump log
        dump            Dump database
@@ -148,6 +210,10 @@ def main(argv = sys.argv[1:]):
         task(argv[1:])
     elif any(argv[0] == x for x in ('c', 'conf', 'config')):
         config(argv[1:])
+    elif 'stats' == argv[0]:
+        stats(argv[1:])
+    elif 'tail' == argv[0]:
+        tail(argv[1:])
     elif 'log' == argv[0]:
         log(argv[1:])
     elif 'dump' == argv[0]:
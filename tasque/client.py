@@ -6,7 +6,9 @@ License: MIT/Expat
 from pprint import pprint
 from typing import *
 import atexit
+import glob
 import io
+import json
 import logging as log
 import math
 import multiprocessing as mp
@@ -21,12 +23,14 @@ import subprocess
 import sys
 import time
 import random
+import zstd
 from . import db
 from . import defs
 from . import daemon
 from . import utils
 from termcolor import colored, cprint
 import rich
+import rich.table
 c = rich.get_console()
 
 class tqClient:
@@ -43,7 +47,7 @@ class tqClient:
         Check if the "running" workers are alive.
         Set their pid field to -1 to indicate abnormal behaviour.
         '''
-        workers = self.db['select id, pid from tq where (not pid is null) and (retval is null)']
+        workers = self.db['select id, pid from tq where (state = ?)', ('running',)]
         wkstat = {taskid: utils.checkpid(int(pid)) for taskid, pid in workers}
         if len(wkstat) == 0 or all(wkstat.values()):
             return True
@@ -51,7 +55,8 @@ class tqClient:
             for taskid, check in wkstat.items():
                 if check:
                     continue
-                self.db(f'UPDATE tq SET pid = -1 WHERE (id = {taskid})')
+                self.db('UPDATE tq SET pid = -1, state = ? WHERE (id = ?)',
+                        ('accident', taskid))
             return False
 
     def stop(self):
@@ -68,13 +73,13 @@ class tqClient:
 
     def kill(self, taskid: int):
         '''
-        Kill the worker specified by given task id
+        Kill the task process specified by given task id
         '''
         if not os.path.exists(defs.TASQUE_DB):
             c.log('cannot find the database.')
             return None
-        sql = f'select pid from tq where (id = {taskid}) limit 1'
-        taskpid = self.db[sql][0]
+        sql = 'select pid from tq where (id = ?) limit 1'
+        taskpid = self.db[sql, (taskid,)][0][0]
         c.log(f'Requested to kill task {taskid} with pid {taskpid}')
         if utils.checkpid(taskpid):
             os.kill(taskpid, signal.SIGTERM)
@@ -93,22 +98,24 @@ class tqClient:
 
     def clear(self):
         '''
-        cleanup finished entries in the database
+        cleanup finished entries in the database, by moving them
+        into the archive.
         '''
-        results = self.db[f'select id from tq where (retval is not "null")']
-        for taskid in [x[0] for x in results]:
-            self.db(f'delete from notes where (id = {taskid})')
-        self.db(f'delete from tq where (retval is not "null")')
-        c.log('cleared (either correctly or incorrectly) finished tasks.')
+        n = self.db.archive()
+        c.log(f'archived {n} (either correctly or incorrectly) finished tasks.')
 
     def enqueue(self, taskid: int = None, pid: int = None,
             cwd: str = None, cmd: str = None, retval: str = None,
             stime: int = None, etime: int = None,
-            pri: int = 0, rsc: float = 1.0) -> None:
+            pri: int = 0, rsc: float = None, rscv: dict = None,
+            auto_rsc: bool = False, entry: str = None,
+            env: dict = None, retry: defs.Retry = None,
+            memo: dict = None) -> int:
         '''
         Enqueue a task into tq database. One must provide (cwd, cmd)
+        Returns the id of the new task.
 
-        id: must, int, task indicator
+        id: opt, None or int, task indicator. None to let the database assign one.
         pid: opt, None or int or bool, int for PID, None for waiting, bool True for complete
         cwd: must, str
         cmd: must, str
@@ -116,17 +123,77 @@ class tqClient:
         stime: opt, None or long, seconds since epoch, start time
         etime: opt, None or long, seconds since epoch, end time
         pri: opt, None or int
-        rsc: opt, None or float.
+        rsc: opt, None or float. None for the default, 1.0 (or the estimate
+            with auto_rsc).
+        rscv: opt, None or dict, vector request e.g. {'cpu': 2, 'memory': 8192}.
+            Only the kinds in config['resource'] are allowed, and at most
+            one GPU card.
+        auto_rsc: opt, bool, estimate the request from similar tasks (see
+            self.estimate). Explicit rsc and rscv entries take precedence.
+        entry: opt, None or str, "module:func" for a python task, which is
+            forked from a warm template process. cmd is then "entry args...".
+        env: opt, None or dict, environment to run the task with, typically
+            a snapshot of the submitter's. None for the daemon's environment.
+        retry: opt, None or defs.Retry, retry policy of the task. Its None
+            fields (and the id) fall back to the config['retry_*'] defaults.
+        memo: opt, None or dict, opt in to result memoization, e.g.
+            {'inputs': ['data/*.csv'], 'env': ['SEED']}: the task is completed
+            from an earlier successful run with the same cwd, cmd, values of
+            the environment variables and contents of the input files.
         '''
-        ids = [t[0] for t in self.db['select id from tq']]
-        taskid = max(ids)+1 if len(ids) > 0 else 1
         if cmd is None:
             raise ValueError('must provide a valid cmd')
-        task = defs.Task._make(utils.none2null(
-            (taskid, pid, cwd, cmd, retval, stime, etime, pri, rsc)))
+        if retry is not None:
+            utils.retrycodes(retry.codes)
+            try:
+                re.compile(retry.pattern or '')
+            except re.error as e:
+                raise ValueError(f'invalid retry pattern {retry.pattern!r}: {e}')
+        kinds = [x.strip() for x in dict(self.db['config'])['resource'].split(',')
+                 if x.strip()]
+        # the daemon would wait forever for what it does not manage
+        unknown = sorted(set(rscv or {}) - set(kinds))
+        if unknown:
+            raise ValueError(f'resource {", ".join(unknown)} is not managed'
+                    + f' by the daemon (resource = {", ".join(kinds)})')
+        if (rscv or {}).get('gpu', 1) != 1:
+            raise ValueError('only one GPU card per task is supported')
+        if auto_rsc:
+            est = self.estimate(cwd, cmd)
+            if est:
+                c.log('Estimated resource from history:', est)
+            if len(kinds) > 1:
+                rscv = {**{k: v for (k, v) in est.items() if k in kinds},
+                        **(rscv or {})}
+            elif kinds[0] in est and rsc is None:
+                rsc = est[kinds[0]]
+        rsc = 1.0 if rsc is None else rsc
+        task = defs.Task(taskid, pid, cwd, cmd, retval, stime, etime,
+                pri, rsc, 'pending', json.dumps(rscv) if rscv else None, entry)
         with c.status('Adding new task to the queue ...'):
-            c.log('Enqueue:', task)
-            self.db += task
+            if memo is not None:
+                memo = defs.Memo(None, json.dumps(list(memo.get('inputs', []))),
+                        json.dumps(list(memo.get('env', []))), None)
+            taskid, = self.db.insert_tasks([task], [env], [retry], [memo])
+            c.log('Enqueue:', task._replace(id=taskid))
+        utils.notify(defs.TASQUE_SOCK, b'enqueue')
+        return taskid
+
+    def estimate(self, cwd: str, cmd: str) -> dict:
+        '''
+        Estimate the resource demand of a task from the peak usage of the
+        successful tasks with the same cwd and normalized cmd, with
+        config['auto_rsc_margin'] (default 1.2) of headroom.
+        Returns e.g. {'memory': 2400, 'vmem': 6000, 'cpu': 2}, with only
+        the known kinds, or an empty dict when there is no history.
+        '''
+        R = self.db['select rss, vmem, cpu from history'
+                + ' where (cwd = ?) and (cmd = ?)', (cwd, utils.normcmd(cmd))]
+        if not R:
+            return dict()
+        margin = float(dict(self.db['config']).get('auto_rsc_margin', 1.2))
+        return {kind: math.ceil(x * margin) for (kind, x)
+                in zip(('memory', 'vmem', 'cpu'), R[0]) if x}
 
     def dequeue(self, taskid: int):
         '''
@@ -134,9 +201,14 @@ class tqClient:
         Do nothing if pid is not empty for sanity.
         '''
         # remove related notes
-        self.db(f'delete from notes where (id = {taskid})')
+        self.db('delete from notes where (id = ?)', (taskid,))
         # remove task itself
-        self.db(f'delete from tq where ((pid is null) or (pid < 0)) and (id = {taskid})')
+        self.db('delete from tq where (state in (?, ?)) and (id = ?)',
+                ('pending', 'accident', taskid))
+        for table in ('env', 'retry', 'memo'):
+            self.db(f'delete from {table} where (id = ?) and (id not in'
+                    + ' (select id from tq where (id = ?)))', (taskid, taskid))
+        utils.notify(defs.TASQUE_SOCK, b'dequeue')
         c.log(f'Removed task <{taskid}> from task queue.')
 
     def dump(self):
@@ -166,27 +238,25 @@ class tqClient:
         tqd = daemon.tqD()
         tqd.Start()
 
-    def annotate(self, taskid: int, note: str):
+    def annotate(self, taskid: int, note: str) -> int:
         '''
-        Take note in a specified task entry
+        Take note in a specified task entry. Returns the id of the note.
         '''
-        # get a noteid
-        R = self.db[f'SELECT noteid FROM notes']
-        noteid = max(x[0] for x in R) + 1 if len(R) > 0 else 1
-        self.db(f'INSERT INTO notes (noteid, id, note) VALUES ({noteid}, {taskid}, {repr(note)})')
+        noteid, = self.db.insert_notes([defs.Note(None, taskid, note)])
         c.log(f'Annotating task<{taskid}>: {note}')
+        return noteid
 
     def delannotation(self, noteid: int) -> None:
         '''
         Remove the note specified by noteid
         '''
-        self.db(f'DELETE FROM notes WHERE (noteid = {noteid})')
+        self.db('DELETE FROM notes WHERE (noteid = ?)', (noteid,))
 
     def dumpannotation(self) -> None:
         '''
         Pretty print of the notes
         '''
-        R = self.db[f'select noteid, id, note from notes']
+        R = self.db['select noteid, id, note from notes']
         for noteid, taskid, note in R:
             symbol = random.choice('♩♪♫♬♭♮♯')
             randcolor = f'\033[{random.randint(0,1)};{random.randint(31,37)}m'
@@ -197,40 +267,137 @@ class tqClient:
         editing Pri and Rsc attributes
         '''
         if pri is not None:
-            self.db(f'UPDATE tq SET pri = {pri} WHERE (id = {taskid}) limit 1')
+            self.db('UPDATE tq SET pri = ? WHERE (id = ?)', (pri, taskid))
         if rsc is not None:
-            self.db(f'UPDATE tq SET rsc = {rsc} WHERE (id = {taskid}) limit 1')
+            self.db('UPDATE tq SET rsc = ? WHERE (id = ?)', (rsc, taskid))
+        utils.notify(defs.TASQUE_SOCK, b'edit')
 
     def config(self, key: str, value: str):
         '''
         edit config in the database
         '''
         if key in [x[0] for x in self.db['config']]:
-            sql = f'UPDATE config SET value = "{value}" WHERE (key = "{key}")'
+            sql = 'UPDATE config SET value = ? WHERE (key = ?)'
+            params = (value, key)
         else:
-            sql = f'INSERT INTO config VALUES ("{key}", "{value}")'
-        c.log(sql)
-        self.db(sql)
+            sql = 'INSERT INTO config (key, value) VALUES (?, ?)'
+            params = (key, value)
+        c.log(sql, params)
+        self.db(sql, params)
+        utils.notify(defs.TASQUE_SOCK, b'config')
+
+    def stats(self, archive: bool = False):
+        '''
+        Statistics of the tasks in the queue (or archive), per state.
+        '''
+        table = defs.DB_TABLE_ARCHIVE if archive else defs.DB_TABLE_TASQUE
+        R = self.db[f'''select state, count(*), sum(etime - stime),
+                avg(etime - stime), max(etime - stime),
+                sum(utime + systime), max(maxrss)
+                from {table} left join usage using (id) group by state''']
+        t = rich.table.Table(title=f'Statistics of {table}')
+        for col in ('State', 'Count', 'Total Time', 'Mean Time', 'Max Time',
+                'CPU Time', 'Max RSS'):
+            t.add_column(col)
+        for state, count, total, mean, longest, cpu, maxrss in R:
+            t.add_row(state, str(count), *[utils.sec2hms(x)
+                if x is not None else '-' for x in (total, mean, longest, cpu)],
+                '-' if maxrss is None else f'{maxrss / 1024:.1f} MiB')
+        c.print(t)
+
+    def _withnotes(self, tasks: Iterable[tuple]) -> Iterator[tuple]:
+        '''
+        Pair a stream of tasks (ordered by id) with their notes.
+        Both sides are streamed, merging on the task id.
+        '''
+        notes = self.db.iter('select id, note from notes order by id, noteid')
+        note = next(notes, None)
+        for task in tasks:
+            tasknotes = []
+            while note is not None and note[0] <= task[0]:
+                if note[0] == task[0]:
+                    tasknotes.append(note[1])
+                note = next(notes, None)
+            yield task, tasknotes
+
+    def outputs(self, taskid: int) -> List[str]:
+        '''
+        Paths to the output files of a task, oldest first.
+        '''
+        pattern = os.path.join(defs.TASQUE_DIR, f'tq_id-{taskid}_*.stdout.zst')
+        return sorted(glob.glob(pattern))
 
-    def tqls(self):
+    def tail(self, taskid: int, *, lines: int = 10, follow: bool = False,
+            interval: float = 0.5):
+        '''
+        Print the last lines of the output of a task. If <follow>, keep
+        printing new output until the task is no longer pending/running.
+        The output file is a sequence of zstd frames, so each poll only
+        decompresses the frames that were completed since the last one.
+        '''
+        out = sys.stdout.buffer
+        path, offset, first = None, 0, True
+        while True:
+            state = self.db['select state from tq where (id = ?)', (taskid,)]
+            alive = bool(state) and state[0][0] in ('pending', 'running')
+            if path is None and self.outputs(taskid):
+                path = self.outputs(taskid)[-1]
+            if path is not None:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+                frames = utils.zstdframes(data)
+                chunks = []
+                for (begin, end) in reversed(frames):
+                    chunks.insert(0, zstd.decompress(data[begin:end]))
+                    if first and sum(x.count(b'\n') for x in chunks) > lines:
+                        break
+                text = b''.join(chunks)
+                if first:
+                    text = b''.join(text.splitlines(keepends=True)[-lines:])
+                out.write(text)
+                out.flush()
+                offset += frames[-1][1] if frames else 0
+            first = False
+            if not (follow and alive):
+                break
+            time.sleep(interval)
+
+    def tqls(self, archive: bool = False):
         '''
         List items in the tq database in pretty format.
+        List the archived tasks instead when <archive> is True.
         This function is bulky ...
         '''
-        tasks = self.db['select * from tq']
-        notes = self.db['select id, note from notes']
+        fields = defs.ARCHIVE_FIELDS.replace(', notes', '')
+        usage = defs.USAGE_FIELDS.replace('id, ', '')
+        if archive:
+            table = defs.DB_TABLE_ARCHIVE
+            R = self.db.iter(f'select {fields}, {usage}, notes from {table}'
+                    + ' left join usage using (id) order by id')
+            rows = ((r[:-1], utils.unpacknotes(r[-1])) for r in R)
+        else:
+            table = defs.DB_TABLE_TASQUE
+            R = self.db.iter(f'select {fields}, {usage} from {table}'
+                    + ' left join usage using (id) order by id')
+            rows = self._withnotes(R)
         cprint('╭───┬'+'─'*73+'╮', 'yellow')
-        for k, task in enumerate(tasks, 1):
-            taskid, pid, cwd, cmd, retval, stime, etime, pri, rsc = task
+        for task, tasknotes in rows:
+            task, ru = task[:10], defs.Usage(task[0], *task[10:])
+            taskid, pid, cwd, cmd, retval, stime, etime, pri, rsc, state = task
             taskid, pid, retval, stime, etime, pri = map(
                     lambda x: x if x is None else int(x),
                     (taskid, pid, retval, stime, etime, pri))
-            if retval is None and pid is None:  # wait
+            if state == 'pending':
                 status = colored('[♨]', 'white')
-            elif retval is not None and pid is None:
-                status = colored('[✓]', 'green') if int(retval) == 0 else colored(f'[✗ {retval}]', 'white', 'on_red')
-            elif retval is None and pid is not None:
-                status = colored(f'[⚙ {pid}]', 'cyan', None, ['bold']) if int(pid) > 0 else colored(f'[⚠ Accident]', 'yellow', None, ['bold'])
+            elif state == 'done':
+                status = colored('[✓]', 'green')
+            elif state == 'failed':
+                status = colored(f'[✗ {retval}]', 'white', 'on_red')
+            elif state == 'running':
+                status = colored(f'[⚙ {pid}]', 'cyan', None, ['bold'])
+            elif state == 'accident':
+                status = colored(f'[⚠ Accident]', 'yellow', None, ['bold'])
             else:
                 status = colored('[???BUG???]', None, 'on_red')
             # first line : status
@@ -244,6 +411,13 @@ class tqClient:
             elif stime:
                 print(colored('│   ├', 'yellow'), colored('☀', 'yellow'), f'Started at ({time.ctime(stime)})',
                       colored(f'➜ {utils.sec2hms(time.time() - stime)}', 'magenta'), 'Elapsed.')
+            # optional: resource usage
+            if ru.utime is not None:
+                print(colored('│   ├', 'yellow'), colored('⚒', 'yellow'),
+                      f'CPU {utils.sec2hms(ru.utime)} user + {utils.sec2hms(ru.systime)} sys',
+                      f'| RSS {ru.maxrss / 1024:.1f} MiB',
+                      f'| IO {ru.inblock}/{ru.oublock} blk',
+                      f'| CS {ru.nvcsw}/{ru.nivcsw}')
             # third line: cwd
             print(colored('│   ├', 'yellow'), colored('⚑', 'yellow'), colored(cwd, 'blue'))
             prog, args = cmd.split()[0], ' '.join(cmd.split()[1:])
@@ -252,19 +426,16 @@ class tqClient:
                     colored(prog, 'magenta', None, ['underline']),
                     colored(args, 'green', None, ['underline']))
             # optional fifth+ lines
-            for taskid, note in [(k, m) for (k, m) in notes if k == taskid]:
+            for note in tasknotes:
                 symbol = random.choice('♩♪♫♬♭♮♯')
                 print(colored('│   │', 'yellow'), colored(symbol, 'cyan') + ' ', note)
             print(colored('├───┼'+'─'*73+'┤', 'yellow'))
         # print summary
-        sql = 'select id from tq where not (pid is null) and (pid > 0)'
-        stat_running = len(self.db[sql])
-        sql = 'select id from tq where (pid is null) and (retval is null)'
-        stat_wait = len(self.db[sql])
-        sql = 'select id from tq where (pid is null) and not (retval is null)'
-        stat_done = len(self.db[sql])
-        sql = 'select id from tq where not (pid is null) and (pid < 0)'
-        stat_accident = len(self.db[sql])
+        stat = dict(self.db[f'select state, count(*) from {table} group by state'])
+        stat_running = stat.get('running', 0)
+        stat_wait = stat.get('pending', 0)
+        stat_done = stat.get('done', 0) + stat.get('failed', 0)
+        stat_accident = stat.get('accident', 0)
 
         tqdstatus = colored('☘', 'green') if self.isdaemonalive() else colored('❄', 'white')
         print(colored('│ ', 'yellow') + tqdstatus + colored(' │', 'yellow'),
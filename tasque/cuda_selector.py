@@ -11,6 +11,7 @@ from collections import namedtuple
 import subprocess as sp
 
 Card = namedtuple('Card', 'index, memory_total, memory_used, memory_free')
+App = namedtuple('App', 'pid, used_memory')
 
 class CudaSelector:
     '''
@@ -32,6 +33,19 @@ class CudaSelector:
                  for line in csv.reader(stat.split('\n'))]
         return cards
 
+    def getApps(self) -> List[App]:
+        '''
+        Get a list of processes using the GPUs, with their memory usage.
+        '''
+        cmd = ['nvidia-smi', '--format=csv,noheader,nounits',
+            '--query-compute-apps=pid,used_memory']
+        stat = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE
+                        ).communicate()[0].decode().strip()
+        apps = [App._make(map(int, line))
+                for line in csv.reader(stat.split('\n'))
+                if len(line) == 2 and all(x.strip().isdigit() for x in line)]
+        return apps
+
     def availCards(self) -> List[Card]:
         '''
         Get a list of AVAILABLE cards.
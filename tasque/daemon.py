@@ -6,10 +6,12 @@ License: MIT/Expat
 from pprint import pprint
 from typing import *
 import atexit
+import glob
+import hashlib
 import io
+import json
 import logging
 import math
-import multiprocessing as mp
 import os
 import re
 import select
@@ -21,17 +23,315 @@ import subprocess
 import sys
 import time
 import random
+import threading
+import queue
+import heapq
 import zstd
 from . import defs
 from . import db
 from . import utils
 from . import resources
+from . import forkserver
+from . import wrapper
+from .cuda_selector import CudaSelector
+
+class tqWriter(threading.Thread):
+    '''
+    The single writer of task state transitions. The scheduler sends events
+    through a queue, and the writer commits whatever arrived
+    within <interval> seconds in one transaction, instead of having many
+    processes contend for the SQLite write lock.
+
+    Events are tuples:
+        ('started', taskid, pid, stime)
+        ('finished', taskid, retval, etime[, usage])
+        ('retry', taskid, retval, etime[, usage])
+        ('cached', taskid, defs.Cached, time)
+        ('archive', before)
+        ('alloc', defs.Alloc)
+        ('memo', taskid, key)
+        ('hashes', [defs.Hash, ...])
+        ('samples', [defs.Sample, ...])
+        ('downsample', before, bucket, expire)
+    where usage is a defs.Usage record, if available. A retval of None
+    means that the exit status is unknown. Both 'finished' and 'retry' end
+    an attempt of the task, but the latter puts it back into the queue.
+    'cached' completes a task from the cached result of an earlier one.
+    '''
+    interval: float = 0.5
+    # seconds between the attempts to commit a failed batch (doubling),
+    # and the number of attempts left when closing
+    delay_max: float = 30.0
+    retries: int = 3
+
+    def __init__(self, dbpath: str, log: object, *,
+            interval: float = None,
+            inflight: set = None):
+        super(tqWriter, self).__init__(name='tqWriter', daemon=True)
+        self.dbpath = dbpath
+        self.log = log
+        self.queue = queue.Queue()
+        if interval is not None:
+            self.interval = interval
+        # ids of launched tasks whose completion is not yet committed
+        self.inflight = set() if inflight is None else inflight
+
+    def put(self, event: tuple) -> None:
+        self.queue.put(event)
+
+    def close(self) -> None:
+        '''
+        Commit the remaining events and stop the thread.
+        '''
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        db_ = db.tqDB(self.dbpath)  # the connection belongs to this thread
+        # a batch that failed to commit (e.g. the database is locked) is
+        # kept, and retried with what arrives meanwhile, after <delay>
+        events, stop, delay, failures = [], False, 0.0, 0
+        while events or not stop:
+            if not events:
+                event = self.queue.get()
+                if event is None:
+                    break
+                events.append(event)
+            deadline = time.time() + max(self.interval, delay)
+            while not stop:
+                try:
+                    event = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                else:
+                    events.append(event)
+            try:
+                self.commit(db_, events)
+                events, delay, failures = [], 0.0, 0
+            except sqlite3.OperationalError as e:
+                failures += 1
+                if stop and failures > self.retries:
+                    self.log.error(f'{self.name}: giving up on {events}: {e}')
+                    break
+                delay = min(2 * max(self.interval, delay), self.delay_max)
+                self.log.error(f'{self.name}: failed to commit {len(events)} events, retrying in {delay:.1f}s: {e}')
+                if stop:
+                    time.sleep(delay)
+            except Exception as e:
+                self.log.error(f'{self.name}: failed to commit {events}: {e}')
+                events = []
+        db_.close()
+
+    def commit(self, db_: db.tqDB, events: list) -> None:
+        finished = []
+        with db_.transaction() as conn:
+            for kind, *args in events:
+                if kind == 'started':
+                    taskid, pid, stime = args
+                    # only pending tasks start: a late 'started' must not
+                    # bring a finished task back to life
+                    conn.execute('update tq set pid = ?, stime = ?, state = ?'
+                            + ' where (id = ?) and (state = ?)',
+                            (pid, stime, 'running', taskid, 'pending'))
+                elif kind in ('finished', 'retry'):
+                    taskid, retval, etime, *usage = args
+                    conn.execute('insert into attempts select id, (select'
+                            + ' count(*) + 1 from attempts where (id = ?)),'
+                            + ' pid, ?, stime, ? from tq where (id = ?)',
+                            (taskid, retval, etime, taskid))
+                    state = 'pending' if kind == 'retry' else \
+                            'accident' if retval is None else \
+                            'done' if retval == 0 else 'failed'
+                    conn.execute('update tq set retval = ?, etime = ?,'
+                            + ' pid = null, state = ? where (id = ?)',
+                            (retval, etime, state, taskid))
+                    usage = usage[0] if usage else None
+                    if usage is not None:
+                        marks = ', '.join('?' * len(usage))
+                        conn.execute(f'insert or replace into usage values ({marks})',
+                                usage)
+                    if state == 'done':
+                        self.learn(conn, taskid, usage)
+                        conn.execute('insert or replace into cache select memo.key,'
+                                + ' memo.id, alloc.output, ? from memo join alloc'
+                                + ' on (alloc.id = memo.id) where (memo.id = ?)'
+                                + ' and (memo.key is not null)', (etime, taskid))
+                    conn.execute('delete from alloc where (id = ?)', (taskid,))
+                    finished.append(taskid)
+                elif kind == 'cached':
+                    taskid, cached, now = args
+                    conn.execute('update tq set pid = null, retval = ?, stime = ?,'
+                            + ' etime = ?, state = ? where (id = ?)',
+                            (0, now, now, 'done', taskid))
+                    conn.execute('insert into notes (id, note) values (?, ?)',
+                            (taskid, f'cached result of task {cached.id}'))
+                    finished.append(taskid)
+                elif kind == 'memo':
+                    taskid, key = args
+                    conn.execute('update memo set key = ? where (id = ?)',
+                            (key, taskid))
+                elif kind == 'hashes':
+                    marks = ', '.join('?' * len(defs.Hash._fields))
+                    conn.executemany(f'insert or replace into hashes values ({marks})',
+                            args[0])
+                elif kind == 'alloc':
+                    marks = ', '.join('?' * len(defs.Alloc._fields))
+                    conn.execute(f'insert or replace into alloc values ({marks})',
+                            args[0])
+                elif kind == 'samples':
+                    marks = ', '.join('?' * len(defs.Sample._fields))
+                    conn.executemany(f'insert into samples values ({marks})',
+                            args[0])
+                elif kind in ('archive', 'downsample'):
+                    continue
+                else:
+                    raise ValueError(f'unknown event {kind}')
+        self.log.info(f'{self.name}: committed {len(events)} events.')
+        self.inflight.difference_update(finished)
+        # (housekeeping: not worth retrying the batch for)
+        for kind, *args in events:
+            try:
+                if kind == 'archive':
+                    n = db_.archive(*args)
+                    if n > 0:
+                        self.log.info(f'{self.name}: Archived {n} finished tasks.')
+                elif kind == 'downsample':
+                    db_.downsample(*args)
+            except sqlite3.Error as e:
+                self.log.error(f'{self.name}: {kind} failed: {e}')
+
+    def learn(self, conn: sqlite3.Connection, taskid: int,
+            usage: defs.Usage = None) -> None:
+        '''
+        Fold the peak usage of a successful task (from its samples and its
+        rusage) into the history of similar tasks.
+        '''
+        task = conn.execute('select cwd, cmd, stime, etime from tq'
+                + ' where (id = ?)', (taskid,)).fetchone()
+        if task is None:
+            return
+        cwd, cmd, stime, etime = task
+        rss, vmem, cpu = conn.execute('select max(rss), max(vmem), max(cpu)'
+                + ' from samples where (id = ?)', (taskid,)).fetchone()
+        if usage is not None:
+            rss = max(rss or 0, usage.maxrss / 1024.)
+            if stime is not None and etime > stime:
+                cpu = max(cpu or 0, (usage.utime + usage.systime) / (etime - stime))
+        conn.execute('''insert into history values (?, ?, 1, ?, ?, ?)
+                on conflict (cwd, cmd) do update set runs = runs + 1,
+                rss = coalesce(max(rss, excluded.rss), rss, excluded.rss),
+                vmem = coalesce(max(vmem, excluded.vmem), vmem, excluded.vmem),
+                cpu = coalesce(max(cpu, excluded.cpu), cpu, excluded.cpu)''',
+                (cwd, utils.normcmd(cmd), rss, vmem, cpu))
+
+
+class tqHasher(threading.Thread):
+    '''
+    Computes the memoization keys of tasks (see memokey) off the main loop
+    of the daemon, since hashing the input files may take long. The keys
+    (None if it failed) are left in self.keys, and the daemon is woken up.
+    '''
+
+    def __init__(self, dbpath: str, log: object, writer: tqWriter):
+        super(tqHasher, self).__init__(name='tqHasher', daemon=True)
+        self.dbpath = dbpath
+        self.log = log
+        self.writer = writer
+        self.queue = queue.Queue()
+        # task id -> key, and the ids still in the queue
+        self.keys, self.requested = dict(), set()
+
+    def request(self, task: defs.Task) -> None:
+        if task.id in self.requested:
+            return
+        self.requested.add(task.id)
+        if self.ident is None:
+            self.start()
+        self.queue.put(task)
+
+    def run(self):
+        db_ = db.tqDB(self.dbpath)  # the connection belongs to this thread
+        while True:
+            task = self.queue.get()
+            try:
+                key = self.memokey(db_, task)
+            except Exception as e:
+                self.log.error(f'{self.name}: cannot compute the memo key of task {task.id}: {e}')
+                key = None
+            self.keys[task.id] = key
+            self.requested.discard(task.id)
+            utils.notify(defs.TASQUE_SOCK, b'memo')
+
+    def memokey(self, db_: db.tqDB, task: defs.Task) -> str:
+        '''
+        The memoization key of a task that opted in (see the memo table),
+        otherwise None: a hash of its cwd, cmd, entry, the values of the
+        declared environment variables (in its recorded environment), and
+        the contents of the declared input files. Since the inputs may be
+        produced by earlier tasks, the key is only computed at launch.
+        '''
+        R = db_['select * from memo where (id = ?)', (task.id,)]
+        if not R:
+            return None
+        memo = defs.Memo._make(R[0])
+        env = db_.environ(task.id) or os.environ
+        inputs = dict()
+        for pattern in json.loads(memo.inputs or '[]'):
+            paths = glob.glob(os.path.join(task.cwd, pattern), recursive=True)
+            inputs[pattern] = [(os.path.relpath(path, task.cwd), self.digest(db_, path))
+                               for path in sorted(paths) if os.path.isfile(path)]
+        material = [task.cwd, task.cmd, task.entry,
+                {k: env.get(k) for k in json.loads(memo.env or '[]')}, inputs]
+        return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+    def digest(self, db_: db.tqDB, path: str) -> str:
+        '''
+        Content hash of a file. Hashes are remembered (in the hashes table)
+        along with the mtime and size of the file, and only computed again
+        when either changes.
+        '''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        R = db_['select * from hashes where (path = ?)', (path,)]
+        known = defs.Hash._make(R[0]) if R else None
+        if known is not None and (known.mtime, known.size) == (st.st_mtime_ns, st.st_size):
+            return known.digest
+        known = defs.Hash(path, st.st_mtime_ns, st.st_size, utils.filehash(path))
+        self.writer.put(('hashes', [known]))
+        return known.digest
+
 
 class tqD:
     '''
     Tasque Daemon. In charge of scheduling and spawning task processes.
     '''
     __name__ = 'tqD'
+    # seconds to wait when pending tasks cannot be scheduled (doubling)
+    backoff_min: float = 0.5
+    backoff_max: float = 16.0
+    # seconds to wait when there is nothing to do at all
+    idle_max: float = 60.0
+    # number of blocked tasks after which a scheduling pass gives up
+    scan_depth: int = 64
+    # telemetry: seconds between samples of the running tasks; samples
+    # older than sample_coarse_after are merged into sample_bucket seconds,
+    # and deleted after sample_retention seconds.
+    sample_interval: float = 30.0
+    sample_coarse_after: float = 3600.0
+    sample_bucket: float = 600.0
+    sample_retention: float = 14 * 86400.0
+    # retry policy defaults (config['retry_*'], see retry()): total number
+    # of attempts, and seconds before the first retry (doubling, capped)
+    retry_attempts: int = 1
+    retry_backoff: float = 60.0
+    retry_backoff_max: float = 3600.0
+    # seconds to wait for the rest of the output of an exited task, when
+    # its retry depends on the output (retry_pattern)
+    retry_grace: float = 60.0
+    # seconds to wait for a template process to fork a python task
+    spawn_timeout: float = 10.0
 
     def __init__(self, *,
             uid:int=os.getuid(),
@@ -51,10 +351,38 @@ class tqD:
                 format='%(levelno)s %(asctime)s %(process)d %(filename)s:%(lineno)d] %(message)s',
                 level=logging.DEBUG)
         self.log = logging
-        self.workerpool = list()
+        # running tasks: pid -> (task, Popen object, pidfd or None)
+        self.workerpool = dict()
         self.config = dict(self.db['config'])
+        # (key, value) of the config entries found invalid (see setting)
+        self.invalid = set()
         self.resource = resources.create(self.config['resource'])
-        self.idle = lambda: time.sleep(1)
+        self.last_archive = 0.0
+        self.last_sample, self.last_downsample = 0.0, 0.0
+        # pid -> (time, CPU time) at the last sample
+        self.cputime = dict()
+        self.cusel = CudaSelector()
+        # warm template processes for python tasks, started on demand
+        self.forkservers, self.next_forkserver = [], 0
+        self.sock = None
+        self.backoff = self.backoff_min
+        # in-memory pending queue: heap of (-pri, id), and id -> task
+        self.pending, self.tasks = [], dict()
+        self.watermark, self.stale, self.last_sync = 0, True, 0.0
+        # tasks to retry: id -> not before (seconds since epoch); and the
+        # ones put back into the queue, whose state is not yet committed
+        self.holds, self.retrying = dict(), set()
+        # exited tasks whose retry waits for their output to be drained:
+        # id -> (task, retval, etime, usage, (policy, attempt) or None)
+        self.exited = dict()
+        # running tasks that were launched by backfilling
+        self.backfilled = set()
+        # task id -> (output thread, tail of the output)
+        self.outputs = dict()
+        self.writer = tqWriter(defs.TASQUE_DB, self.log,
+                interval=self.setting('flush_interval', tqWriter.interval))
+        # memoization keys, computed on demand
+        self.hasher = tqHasher(defs.TASQUE_DB, self.log, self.writer)
 
     def Start(self):
         '''
@@ -111,18 +439,217 @@ class tqD:
            raise SystemExit(1)
         signal.signal(signal.SIGTERM, sigterm_handler)
 
-    def refresh_workerpool(self):
-        # cleanup the worker pool regularly, removing dead workers
-        wp_ = []
-        for (taskpid, w) in self.workerpool:
-            if w.is_alive():
-                wp_.append((taskpid, w))
-            else:
-                w.join(timeout=3)
-                w.terminate()
-                if taskpid in self.resource.book:
-                    self.resource.release[taskpid]()
-        self.workerpool = wp_
+    def listen(self):
+        '''
+        Set up the notification channels that wake the scheduler up: a unix
+        datagram socket in TASQUE_DIR for the clients, and a socket pair to
+        which SIGCHLD is forwarded. The latter is how we learn about task
+        exit when pidfd_open(2) is not available.
+        '''
+        if os.path.exists(defs.TASQUE_SOCK):
+            os.unlink(defs.TASQUE_SOCK)
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(defs.TASQUE_SOCK)
+            self.sock.setblocking(False)
+            path = defs.TASQUE_SOCK
+            atexit.register(lambda: os.path.exists(path) and os.unlink(path))
+        except OSError as e:
+            self.log.warning(f'{self.__name__}[{os.getpid()}] cannot listen on {defs.TASQUE_SOCK}: {e}. Falling back to polling.')
+            self.sock = None
+        self.sigr, self.sigw = socket.socketpair()
+        self.sigr.setblocking(False)
+        self.sigw.setblocking(False)
+        signal.set_wakeup_fd(self.sigw.fileno(), warn_on_full_buffer=False)
+        # a python-level handler is needed for the wakeup fd to be written
+        signal.signal(signal.SIGCHLD, lambda signo, frame: None)
+
+    def idle(self, busy: bool = True):
+        '''
+        Sleep until something happens (task submission, task exit, config
+        change) or until timeout. If <busy>, i.e. some pending task could not
+        be scheduled, we have to poll the resources from time to time, with
+        an exponential backoff. Otherwise we only wake up for housekeeping.
+        '''
+        timeout = self.backoff if busy else self.idle_max
+        interval = self.setting('sample_interval', self.sample_interval)
+        if self.workerpool and interval > 0:
+            timeout = min(timeout, max(0.0, self.last_sample + interval - time.time()))
+        # (expired holds are dropped by schedule(): those of tasks that are
+        # blocked on resources would make us spin)
+        holds = [x for x in self.holds.values() if x > time.time()]
+        if holds:
+            timeout = min(timeout, max(0.0, min(holds) - time.time()))
+        # exited tasks to settle, and retries to pick up once committed
+        if self.exited or self.retrying:
+            timeout = min(timeout, self.backoff_min)
+        fds = [x for x in (self.sock, self.sigr) if x is not None]
+        pidfds = [x for (_, _, x) in self.workerpool.values() if x is not None]
+        servers = [x for x in self.forkservers if not x.dead]
+        ready, _, _ = select.select(fds + pidfds + servers, [], [], timeout)
+        messages = []
+        for fd in ready:
+            if isinstance(fd, int):
+                continue  # pidfd: the exit status is collected by reap()
+            if isinstance(fd, forkserver.tqForkServer):
+                fd.poll()  # exit notifications of python tasks
+                continue
+            while True:
+                try:
+                    messages.append(fd.recv(4096))
+                except BlockingIOError:
+                    break
+        if ready:
+            self.backoff = self.backoff_min
+        elif busy:
+            self.backoff = min(2 * self.backoff, self.backoff_max)
+        if any(x in messages for x in (b'edit', b'dequeue')):
+            self.stale = True
+        if b'config' in messages:
+            self.config = dict(self.db['config'])
+            self.log.info(f'{self.__name__}[{os.getpid()}] Reloaded config: {self.config}')
+
+    def reap(self, block: bool = False) -> int:
+        '''
+        Collect the exit status of finished tasks, release their resources,
+        and record their completion (see settle). Returns the number of
+        reaped tasks. If <block>, wait for all the running tasks to finish.
+        '''
+        reaped = 0
+        for pid, (task, proc, pidfd) in list(self.workerpool.items()):
+            try:
+                if isinstance(proc, subprocess.Popen):
+                    wpid, status, ru = os.wait4(pid, 0 if block else os.WNOHANG)
+                else:
+                    wpid, status, ru = proc.wait4(pid, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                wpid, status, ru = pid, None, None
+            if wpid == 0:
+                continue
+            if status is None:
+                # not our child: its status file tells how it ended, if any
+                status, ru = wrapper.readstatus(tasqueStatus(task))
+            retval = None if status is None else os.waitstatus_to_exitcode(status)
+            if isinstance(proc, subprocess.Popen):
+                proc.returncode = retval
+            usage = None if ru is None else defs.Usage(task.id,
+                    ru.ru_utime, ru.ru_stime, ru.ru_maxrss, ru.ru_inblock,
+                    ru.ru_oublock, ru.ru_nvcsw, ru.ru_nivcsw)
+            self.log.info(f'{self.__name__}[{os.getpid()}] Task {task.id} exited: {retval}')
+            self.exited[task.id] = (task, retval, time.time(), usage,
+                    self.retry(task, retval))
+            del self.workerpool[pid]
+            if pidfd is not None:
+                os.close(pidfd)
+            # the output thread reads the rest of the spool, then stops
+            if task.id in self.outputs:
+                self.outputs[task.id][2].set()
+            for path in (tasqueSpool(task), tasqueStatus(task)):
+                if os.path.exists(path):
+                    os.unlink(path)
+            if task.id in self.resource.book:
+                self.resource.release[task.id]()
+            self.backfilled.discard(task.id)
+            reaped += 1
+        self.settle(force=block)
+        return reaped
+
+    def settle(self, force: bool = False) -> None:
+        '''
+        Record the end of the exited tasks: finished, or to be retried. A
+        task whose retry depends on its output (policy.pattern) waits until
+        its output is drained, or for retry_grace seconds, without blocking
+        the loop. With <force>, decide right away with what is there.
+        '''
+        for taskid, (task, retval, etime, usage, retry) in list(self.exited.items()):
+            thread, tail, _ = self.outputs.get(taskid, (None, b'', None))
+            if retry is not None and retry[0].pattern and not force \
+                    and thread is not None and thread.is_alive() \
+                    and time.time() < etime + self.retry_grace:
+                continue
+            del self.exited[taskid]
+            self.outputs.pop(taskid, None)
+            if retry is not None and retry[0].pattern and \
+                    re.search(retry[0].pattern.encode(), bytes(tail)) is None:
+                retry = None
+            kind = 'finished' if retry is None else 'retry'
+            event = (kind, taskid, retval, etime, usage)
+            self.log.info(f'{self.__name__}[{os.getpid()}] Task exited: {event}')
+            self.writer.put(event)
+            if retry is not None:
+                policy, n = retry
+                delay = self.backoff_of(taskid, n)
+                self.log.info(f'{self.__name__}[{os.getpid()}] Task {taskid} failed with {retval} (attempt {n}/{policy.attempts}), retrying in {delay:.0f}s.')
+                self.holds[taskid] = time.time() + delay
+                self.retrying.add(taskid)
+
+    def setting(self, key: str, default: object, kind: type = None) -> object:
+        '''
+        config[key] as <kind> (by default, the type of <default>), or
+        <default> if it is not set or not valid (e.g. "30s" for a number of
+        seconds), since the config can be changed at any time. Invalid
+        values are logged once.
+        '''
+        value = self.config.get(key)
+        if value is None:
+            return default
+        try:
+            return (kind or type(default))(value)
+        except (TypeError, ValueError):
+            if (key, value) not in self.invalid:
+                self.invalid.add((key, value))
+                self.log.error(f'{self.__name__}[{os.getpid()}] Invalid config {key}={value!r}, using {default!r} instead.')
+            return default
+
+    def autoarchive(self):
+        '''
+        Move tasks that finished more than config['archive_after'] seconds
+        ago into the archive, so that the hot table only holds recent work.
+        '''
+        after = self.setting('archive_after', None, float)
+        if after is None:
+            return
+        if time.time() - self.last_archive < 60:
+            return
+        self.last_archive = time.time()
+        self.writer.put(('archive', time.time() - after))
+
+    def sample(self) -> None:
+        '''
+        Sample the CPU utilization, RSS and GPU memory of the process tree
+        of every running task, every config['sample_interval'] seconds (0
+        disables sampling). Old samples are downsampled, then expired.
+        '''
+        interval = self.setting('sample_interval', self.sample_interval)
+        now = time.time()
+        if interval <= 0 or now < self.last_sample + interval:
+            return
+        self.last_sample = now
+        apps = dict()
+        if self.workerpool and self.cusel is not None:
+            try:
+                apps = dict(self.cusel.getApps())
+            except (OSError, ValueError) as e:
+                self.log.info(f'{self.__name__}[{os.getpid()}] GPU memory will not be sampled: {e}')
+                self.cusel = None
+        samples, cputime = [], dict()
+        for pid, (task, _, _) in self.workerpool.items():
+            pids = [pid] + utils.descendants(pid)
+            cpu, rss = utils.proctree(pids)
+            last, lastcpu = self.cputime.get(pid, (None, None))
+            util = None if last is None else (cpu - lastcpu) / (now - last)
+            vmem = sum(apps.get(x, 0) for x in pids) if apps else None
+            samples.append(defs.Sample(task.id, now, util, rss, vmem))
+            cputime[pid] = (now, cpu)
+        self.cputime = cputime
+        if samples:
+            self.writer.put(('samples', samples))
+        bucket = self.setting('sample_bucket', self.sample_bucket)
+        if now - self.last_downsample >= bucket:
+            self.last_downsample = now
+            coarse = self.setting('sample_coarse_after', self.sample_coarse_after)
+            retention = self.setting('sample_retention', self.sample_retention)
+            self.writer.put(('downsample', now - coarse, bucket, now - retention))
 
     def daemonLoop(self):
         '''
@@ -130,89 +657,562 @@ class tqD:
         '''
         self.log.info(f'{self.__name__}[{os.getpid()}] All set. Here we go!')
         self.log.info(f'{self.__name__}[{os.getpid()}] I am watching SQLite3 databse ...')
+        self.listen()
+        self.recover()
+        self.writer.start()
+        try:
+            self._daemonLoop()
+        finally:
+            # the running tasks are left alone, to be adopted by the next
+            # daemon (see recover)
+            self.reap()
+            self.settle(force=True)
+            if self.workerpool:
+                self.log.info(f'{self.__name__}[{os.getpid()}] Leaving {len(self.workerpool)} running tasks behind.')
+            for server in self.forkservers:
+                server.close(wait=not any(p is server
+                        for (_, p, _) in self.workerpool.values()))
+            self.writer.close()
 
+    def _daemonLoop(self):
         while True:
-            # Assessment: should I be idle?
-            R = self.db[f'select id, pri from tq where (pid is "null") and (retval is "null")']
-            if not R:
-                self.refresh_workerpool()
-                self.idle()
+            self.autoarchive()
+            self.sample()
+            # record finished tasks, releasing their resources
+            self.reap()
+            launched, blocked = self.schedule()
+            # sleep until something changes
+            self.idle(busy=(blocked > 0))
+
+    def sync(self, full: bool = False) -> None:
+        '''
+        Bring the in-memory pending queue up to date. Task ids only grow, so
+        normally we only fetch the pending tasks above the watermark. A full
+        rescan is only needed when the clients changed existing tasks.
+        '''
+        if full:
+            R = self.db.iter('select * from tq where (state = ?)', ('pending',))
+            # launched tasks may not have been committed as running yet
+            self.tasks = {r[0]: defs.Task._make(r) for r in R
+                          if r[0] not in self.writer.inflight}
+            self.pending = [(-t.pri, t.id) for t in self.tasks.values()]
+            heapq.heapify(self.pending)
+            # never lowered: launched tasks may be above the pending ones
+            self.watermark = max(self.watermark, *self.tasks.keys())
+            self.stale, self.last_sync = False, time.time()
+            self.retrying &= self.writer.inflight
+            # the retries to come (also those of a previous daemon)
+            R = self.db['select attempts.id, count(*), max(attempts.etime)'
+                    + ' from attempts join tq on (tq.id = attempts.id)'
+                    + ' where (tq.state = ?) group by attempts.id', ('pending',)]
+            self.holds = {k: v for (k, v) in self.holds.items() if k in self.retrying}
+            holds = ((k, etime + self.backoff_of(k, n)) for (k, n, etime) in R
+                     if k in self.tasks and etime is not None)
+            self.holds.update((k, v) for (k, v) in holds if v > time.time())
+            return None
+        # the retried tasks are back in the queue once committed
+        for taskid in list(self.retrying - self.writer.inflight):
+            self.retrying.discard(taskid)
+            R = self.db['select * from tq where (id = ?) and (state = ?)',
+                    (taskid, 'pending')]
+            if R:
+                self.tasks[taskid] = defs.Task._make(R[0])
+                heapq.heappush(self.pending, (-self.tasks[taskid].pri, taskid))
+        # (unary + keeps sqlite from scanning the state index: id is the key)
+        R = self.db.iter('select * from tq where (+state = ?) and (id > ?) order by id',
+                ('pending', self.watermark))
+        for r in R:
+            task = defs.Task._make(r)
+            self.watermark = task.id
+            if task.id in self.writer.inflight:
+                continue  # launched, but not yet committed as running
+            self.tasks[task.id] = task
+            heapq.heappush(self.pending, (-task.pri, task.id))
+
+    def schedule(self) -> (int, int):
+        '''
+        One scheduling pass: launch every pending task that fits into the
+        available resources, in the order of (priority, FIFO).
+
+        With config['scheduler'] = 'fifo' (default), a priority level is only
+        considered when no task of the higher levels is blocked. With
+        'backfill', tasks of
+        lower priorities are considered as well: the first blocked task of
+        the highest priority reserves its resource, and lower priority tasks
+        may only run in what it cannot use anyway (see resource.reserve),
+        so that they never delay it, even when they outlive the tasks it is
+        waiting for. A pass gives up after config['scan_depth'] blocked tasks.
+
+        Returns the number of launched tasks and of those left waiting.
+        '''
+        self.sync(full=(self.stale or time.time() - self.last_sync > self.idle_max))
+        if not self.pending:
+            return 0, 0
+        backfill = (self.config.get('scheduler', 'fifo') == 'backfill')
+        depth = self.setting('scan_depth', self.scan_depth)
+        # take one snapshot of the resource status for the whole pass
+        self.resource.refresh()
+        launched, blocked, hpri, head, reserved = 0, 0, None, None, False
+        pushback = []
+        while self.pending and blocked < depth:
+            entry = heapq.heappop(self.pending)
+            task = self.tasks.get(entry[1])
+            # stale entry: launched, removed, or priority changed
+            if task is None or task.pri != -entry[0]:
                 continue
-            # find the highest priority among pending jobs
-            hpri = max(x[1] for x in R) if len(R)>0 else 0
-            # traverse the task list of priority <pri> that we can run
-            R = self.db[f'select * from tq where (pid is "null") and (retval is "null") and (pri = {hpri}) order by id']
-            tasks = [defs.Task._make(utils.null2none(r)) for r in R]
-            for task in tasks:
-                # can we allocate the required resource?
-                if not self.resource.canalloc(task.rsc):
+            # waiting for its retry
+            if task.id in self.holds:
+                if self.holds[task.id] > time.time():
+                    pushback.append(entry)
                     continue
-                # spawn the worker process
-                self.log.info(f'{self.__name__}[{os.getpid()}] Next task: {str(task)}')
-                # create a new worker process for this task
-                worker = mp.Process(target=tasqueWorker,
-                        args=(self.db, self.log, task))
-                worker.start()
-                # allocate resource
-                self.workerpool.append((worker.pid, worker))
-                self.resource.request(worker.pid, task.rsc)
-                self.resource.acquire[worker.pid]()
-                break
-            # cleanup the worker pool regularly, removing dead workers
-            self.refresh_workerpool()
-            self.idle()
-
-def tasqueWorker(
-        db: db.tqDB,
+                del self.holds[task.id]
+            # nothing blocked at the top priority: the next one becomes the top
+            if hpri is None or (task.pri < hpri and head is None):
+                hpri = task.pri
+            if task.pri < hpri:
+                if not backfill:
+                    pushback.append(entry)
+                    break
+                # entering the lower priorities: hold the resource for the head
+                if head is not None and not reserved:
+                    self.log.info(f'{self.__name__}[{os.getpid()}] Reserving resource for task {head.id}, backfilling.')
+                    self.resource.reserve(-head.id, self.demand(head),
+                            backfilled=self.backfilled)
+                    reserved = True
+            # can we allocate the required resource?
+            if not self.resource.canalloc(self.demand(task)):
+                blocked += 1
+                pushback.append(entry)
+                if head is None and task.pri == hpri:
+                    head = task
+                continue
+            # the client may have changed it behind our back
+            R = self.db['select * from tq where (id = ?) and (state = ?)', (task.id, 'pending')]
+            del self.tasks[task.id]
+            if not R or defs.Task._make(R[0]) != task:
+                self.stale = True
+                self.hasher.keys.pop(task.id, None)
+                continue
+            # python tasks wait for a template to be ready
+            if task.entry and self.forkserver(peek=True) is None:
+                self.tasks[task.id] = task
+                pushback.append(entry)
+                continue
+            # memoized tasks wait for their key, which is computed off the loop
+            if task.id not in self.hasher.keys and \
+                    self.db['select id from memo where (id = ?)', (task.id,)]:
+                self.hasher.request(task)
+                self.tasks[task.id] = task
+                pushback.append(entry)
+                continue
+            self.launch(task)
+            if reserved:
+                self.backfilled.add(task.id)
+            launched += 1
+        if reserved:
+            self.resource.release[-head.id]()
+        for entry in pushback:
+            heapq.heappush(self.pending, entry)
+        return launched, blocked
+
+    def demand(self, task: defs.Task) -> object:
+        '''
+        What a task asks from self.resource: its vector request for a
+        composite resource, otherwise the scalar rsc (or the component of
+        the vector that matches the kind of resource).
+        '''
+        if task.rscv is None:
+            return task.rsc
+        vec = json.loads(task.rscv)
+        if isinstance(self.resource, resources.CompositeResource):
+            return vec
+        return vec.get(self.config['resource'], task.rsc)
+
+    def policy(self, taskid: int) -> defs.Retry:
+        '''
+        The retry policy of a task: its own settings (the retry table), and
+        config['retry_attempts'], ['retry_backoff'], ['retry_codes'],
+        ['retry_pattern'] for the rest. Raises ValueError if it is invalid.
+        '''
+        R = self.db['select * from retry where (id = ?)', (taskid,)]
+        own = defs.Retry._make(R[0]) if R else defs.Retry(taskid, *[None] * 4)
+        def get(field, default):
+            value = getattr(own, field)
+            return self.config.get(f'retry_{field}', default) if value is None else value
+        policy = defs.Retry(taskid, int(get('attempts', self.retry_attempts)),
+                float(get('backoff', self.retry_backoff)),
+                str(get('codes', '')), str(get('pattern', '')))
+        utils.retrycodes(policy.codes)
+        try:
+            re.compile(policy.pattern.encode())
+        except re.error as e:
+            raise ValueError(f'invalid pattern {policy.pattern!r}: {e}')
+        return policy
+
+    def backoff_of(self, taskid: int, n: int) -> float:
+        '''
+        Seconds to wait after the <n>-th attempt of a task before the next.
+        '''
+        try:
+            limit = float(self.config.get('retry_backoff_max', self.retry_backoff_max))
+            return min(self.policy(taskid).backoff * 2 ** (n - 1), limit)
+        except ValueError as e:
+            self.log.error(f'{self.__name__}[{os.getpid()}] Bad retry policy of task {taskid}: {e}')
+            return 0.0
+
+    def retry(self, task: defs.Task, retval: int) -> (defs.Retry, int):
+        '''
+        Whether a task that exited with <retval> is to be run again,
+        according to its policy: it has attempts left, and its exit code is
+        one of policy.codes (by default, any positive one: tasks killed by
+        a signal, e.g. by tq kill, are not retried). Its output must match
+        policy.pattern too, if any, which is up to the caller (see settle).
+        Returns the policy and the number of this attempt, or None.
+        A task with an invalid policy is not retried.
+        '''
+        if retval is None or retval == 0:
+            return None
+        try:
+            policy = self.policy(task.id)
+        except ValueError as e:
+            self.log.error(f'{self.__name__}[{os.getpid()}] Bad retry policy of task {task.id}: {e}')
+            return None
+        if policy.attempts <= 1:
+            return None
+        codes = utils.retrycodes(policy.codes)
+        if (retval not in codes) if codes else (retval < 0):
+            return None
+        n = self.db['select count(*) from attempts where (id = ?)', (task.id,)][0][0] + 1
+        if n >= policy.attempts:
+            return None
+        return policy, n
+
+    def recall(self, task: defs.Task, key: str) -> bool:
+        '''
+        Complete a task from the cache, if a successful run with the same
+        memoization <key> is known. Its output file (if any, and if still
+        there) is linked as the output of the task. Returns whether it was.
+        '''
+        R = self.db['select * from cache where (key = ?)', (key,)]
+        if not R:
+            return False
+        cached = defs.Cached._make(R[0])
+        if os.path.exists(cached.output):
+            timestamp = time.strftime('%Y%m%d.%H%M%S')
+            output = os.path.join(defs.TASQUE_DIR, f'tq_id-{task.id}_{timestamp}.stdout.zst')
+            try:
+                os.link(cached.output, output)
+            except OSError:
+                os.symlink(cached.output, output)
+        self.log.info(f'{self.__name__}[{os.getpid()}] Task {task.id} completed from the cached result of task {cached.id}')
+        self.writer.put(('cached', task.id, cached, time.time()))
+        return True
+
+    def forkserver(self, peek: bool = False) -> forkserver.tqForkServer:
+        '''
+        A ready template process for python tasks, in a round-robin manner.
+        The pool has config['python_pool'] (default 1) templates, with the
+        comma-separated modules in config['python_preload'] pre-imported.
+        Dead templates are replaced.
+
+        A new template is only ready once it has imported the modules,
+        which may take seconds (e.g. torch): until then this is None, and
+        the template wakes the daemon up when it is ready (see idle). With
+        <peek>, the round-robin does not move on.
+        '''
+        size = max(1, self.setting('python_pool', 1))
+        modules = [x.strip() for x in
+                self.config.get('python_preload', '').split(',') if x.strip()]
+        self.forkservers = [x for x in self.forkservers
+                if x.alive() or any(p is x for (_, p, _) in self.workerpool.values())]
+        live = [x for x in self.forkservers if x.alive()]
+        for _ in range(size - len(live)):
+            server = forkserver.tqForkServer(modules)
+            self.log.info(f'{self.__name__}[{os.getpid()}] Started template process {server.proc.pid} for python tasks, preloading {modules}')
+            self.forkservers.append(server)
+        ready = [x for x in live if x.ready]
+        if not ready or peek:
+            return ready[self.next_forkserver % len(ready)] if ready else None
+        self.next_forkserver = (self.next_forkserver + 1) % len(ready)
+        return ready[self.next_forkserver]
+
+    def launch(self, task: defs.Task) -> None:
+        '''
+        Spawn the task process, and allocate its resource. The exit of the
+        process is noticed through its pidfd (or SIGCHLD) in idle(). Python
+        tasks (task.entry) are forked from a warm template process instead.
+
+        The resource is booked under the task id, and placed before the
+        spawn so that its environment (e.g. CUDA_VISIBLE_DEVICES) goes into
+        the environment of the task: the submitter's environment if it was
+        recorded, otherwise the daemon's. Likewise the task pins itself to
+        its cores (resource.affinity) before it runs.
+
+        Tasks that opted in to memoization are completed right away from the
+        cache when possible (see tqHasher.memokey and recall), without
+        running.
+
+        The output goes into a spool file (see tasqueSpool), which the daemon
+        follows, so that the task never waits for the daemon, even when
+        there is none. Command line tasks run under a wrapper (see the
+        wrapper module) and python tasks under their template, which record
+        their exit status (see tasqueStatus) for whichever daemon is there
+        when they exit.
+        '''
+        self.log.info(f'{self.__name__}[{os.getpid()}] Next task: {str(task)}')
+        self.writer.inflight.add(task.id)
+        key = self.hasher.keys.pop(task.id, None)
+        try:
+            if key is not None and self.recall(task, key):
+                return
+        except Exception as e:
+            # run it then
+            self.log.error(f'{self.__name__}[{os.getpid()}] Cannot complete task {task.id} from the cache: {str(e)}')
+        timestamp = time.strftime('%Y%m%d.%H%M%S')
+        output = os.path.join(defs.TASQUE_DIR, f'tq_id-{task.id}_{timestamp}.stdout.zst')
+        r, w = None, None
+        try:
+            # (a request the resource cannot place fails this task only)
+            self.resource.request(task.id, self.demand(task))
+            env = self.db.environ(task.id)
+            env = {**(os.environ if env is None else env),
+                    **self.resource.environ.get(task.id, {})}
+            cmd = shlex.split(task.cmd)
+            cpus = self.resource.affinity.get(task.id)
+            status = tasqueStatus(task)
+            if os.path.exists(status):
+                os.unlink(status)
+            w = os.open(tasqueSpool(task), os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                    | os.O_APPEND, 0o600)
+            r = os.open(tasqueSpool(task), os.O_RDONLY)
+            if task.entry:
+                proc = self.forkserver()
+                if proc is None:
+                    raise OSError('no template process is ready')
+                pid = proc.spawn(task.entry, cmd[1:], task.cwd, w, env=env,
+                        timeout=self.spawn_timeout, status=status, cpus=cpus)
+            else:
+                pin = ['--cpus', ','.join(map(str, cpus))] if cpus else []
+                proc = subprocess.Popen([sys.executable, '-I', '-S',
+                        wrapper.__file__] + pin + [status] + cmd, shell=False, stdin=None,
+                        stdout=w, stderr=subprocess.STDOUT, cwd=task.cwd, env=env)
+                pid = proc.pid
+        except Exception as e:
+            self.log.error(f'{self.__name__}[{os.getpid()}] Failed to start task {task.id}: {str(e)}')
+            self.resource.cancel(task.id)
+            if r is not None:
+                os.close(r)
+            if w is not None:
+                os.unlink(tasqueSpool(task))
+            now = time.time()
+            self.writer.put(('started', task.id, None, now))
+            self.writer.put(('finished', task.id, -1, now))
+            return
+        finally:
+            if w is not None:
+                os.close(w)
+        self.writer.put(('started', task.id, pid, time.time()))
+        if key is not None:
+            self.writer.put(('memo', task.id, key))
+        try:
+            # python tasks are not our children: the template reports them
+            pidfd = None if task.entry else os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            pidfd = None  # rely on SIGCHLD
+        self.watch(task, pid, proc, pidfd, open(r, 'rb'), output)
+        # allocate resource
+        self.resource.acquire[task.id](pid)
+        self.writer.put(('alloc', defs.Alloc(task.id, pid, utils.procstart(pid),
+            output, json.dumps(self.resource.placement(task.id)))))
+
+    def watch(self, task: defs.Task, pid: int, proc: object, pidfd: int,
+            spool: io.BufferedReader, output: str) -> None:
+        '''
+        Keep track of a running task: collect its output, and wait for it.
+        '''
+        tail, done = bytearray(), threading.Event()
+        thread = threading.Thread(target=tasqueOutput,
+                args=(spool, self.log, task),
+                kwargs=dict(path=output, tail=tail, done=done), daemon=True)
+        thread.start()
+        self.outputs[task.id] = (thread, tail, done)
+        self.workerpool[pid] = (task, proc, pidfd)
+
+    def recover(self) -> None:
+        '''
+        Adopt the tasks left running by a previous daemon (e.g. across a
+        restart or an upgrade), according to the allocation ledger: book
+        their resources again, follow their output spool again from where
+        the previous daemon stopped, and watch them. The tasks that exited
+        in between are adopted as well, and settled right away: their exit
+        status is in their status file. Entries whose process is gone
+        without a status (or whose pid now belongs to another process, i.e.
+        the start time differs), or without their spool, are closed as
+        accidents.
+        '''
+        for alloc in self.db['alloc']:
+            R = self.db['select * from tq where (id = ?)', (alloc.id,)]
+            task = defs.Task._make(R[0]) if R else None
+            paths = [] if task is None else [tasqueSpool(task), tasqueStatus(task)]
+            if task is None or not os.path.exists(paths[0]) or not (
+                    utils.procstart(alloc.pid) == alloc.pstart
+                    or os.path.exists(paths[1])):
+                self.log.warning(f'{self.__name__}[{os.getpid()}] Task {alloc.id} (pid {alloc.pid}) is gone.')
+                with self.db.transaction() as conn:
+                    conn.execute('update tq set pid = -1, state = ? where (id = ?)'
+                            + ' and (state in (?, ?))',
+                            ('accident', alloc.id, 'running', 'accident'))
+                    conn.execute('delete from alloc where (id = ?)', (alloc.id,))
+                for path in paths:
+                    if os.path.exists(path):
+                        os.unlink(path)
+                continue
+            self.log.info(f'{self.__name__}[{os.getpid()}] Adopting task {alloc.id} (pid {alloc.pid})')
+            try:
+                self.resource.adopt(task.id, alloc.pid, json.loads(alloc.placement))
+            except Exception as e:
+                self.log.error(f'{self.__name__}[{os.getpid()}] Cannot book again the resource of task {task.id}: {e}')
+            try:
+                pidfd = os.pidfd_open(alloc.pid)
+            except (AttributeError, OSError):
+                pidfd = None  # rely on polling
+            spool = open(paths[0], 'rb')
+            spool.seek(tasqueDrained(alloc.output))
+            self.watch(task, alloc.pid, tqAdopted(alloc.pstart, paths[1]), pidfd,
+                    spool, alloc.output)
+            self.writer.inflight.add(task.id)
+            self.db('update tq set pid = ?, state = ? where (id = ?)',
+                    (alloc.pid, 'running', task.id))
+
+class tqAdopted:
+    '''
+    A task process adopted from a previous daemon. It is not our child, so
+    we only notice that it is gone (with its pidfd, or by polling), and its
+    exit status is read from its <status> file (see reap). The file is
+    written by its parent right after it is gone: we wait <grace> seconds
+    for it.
+    '''
+    grace: float = 1.0
+
+    def __init__(self, pstart: int, status: str):
+        self.pstart = pstart
+        self.status = status
+        self.gone = None
+
+    def wait4(self, pid: int, options: int = 0) -> (int, int, object):
+        while True:
+            if utils.procstart(pid) != self.pstart:
+                self.gone = self.gone or time.time()
+                if os.path.exists(self.status) or time.time() > self.gone + self.grace:
+                    return pid, None, None
+            if options & os.WNOHANG:
+                return 0, 0, None
+            time.sleep(0.1 if self.gone else 0.5)
+
+
+def tasqueSpool(task: defs.Task) -> str:
+    '''
+    Path to the spool file in TASQUE_DIR into which a task writes its
+    output, and from which the daemon collects it (see tasqueOutput).
+    '''
+    return os.path.join(defs.TASQUE_DIR, f'tq_id-{task.id}.spool')
+
+
+def tasqueStatus(task: defs.Task) -> str:
+    '''
+    Path to the file in TASQUE_DIR recording the exit status of a task
+    (see wrapper.writestatus).
+    '''
+    return os.path.join(defs.TASQUE_DIR, f'tq_id-{task.id}.status')
+
+
+def tasqueDrained(output: str) -> int:
+    '''
+    How much of the spool has been collected into the <output> file, i.e.
+    the decompressed size of its frames. A trailing frame that was cut
+    short (e.g. the daemon died while writing it) is dropped.
+    '''
+    try:
+        with open(output, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0
+    frames = utils.zstdframes(data)
+    end = frames[-1][1] if frames else 0
+    if end < len(data):
+        os.truncate(output, end)
+    return utils.zstdsize(data[:end])
+
+
+def tasqueOutput(
+        spool: io.BufferedReader,
         log: object,
         task: defs.Task,
+        *,
+        path: str = None,
+        chunk: int = 1 << 20,
+        interval: float = 5.0,
+        tail: bytearray = None,
+        done: threading.Event = None,
+        poll: float = 0.5,
+        linger: float = 1.0,
         ):
     '''
-    worker function for processing a Task.
-    (id, pid, cwd, cmd, retval, stime, etime, pri, rsc)
+    Stream the output of a task process (stderr is redirected to stdout)
+    from its <spool> into TASQUE_DIR. The output is compressed chunk by
+    chunk, each chunk being an independent zstd frame, so that memory use
+    is bounded by <chunk> bytes and what has been written so far is
+    readable (zstdcat) even if the task or the daemon dies. Pending output
+    is flushed at least every <interval> seconds. The last 64KB of the
+    output are kept in <tail>, if given.
+
+    The spool is followed (every <poll> seconds when there is nothing new)
+    until <done> is set, i.e. the task exited, and nothing more came for
+    <linger> seconds (e.g. from what the task left running). Without
+    <done>, it is read until EOF (e.g. a pipe).
     '''
-    pid = os.getpid()
-    # update database before working
-    sql = f"update tq set pid = {pid}, stime = {time.time()} where (id = {task.id})"
-    log.info(f'worker[{os.getpid()}]: SQL(pre-task) -- {sql}')
-    db(sql)
-    # trying to start task
+    if path is None:
+        timestamp = time.strftime('%Y%m%d.%H%M%S')
+        path = os.path.join(defs.TASQUE_DIR, f'tq_id-{task.id}_{timestamp}.stdout.zst')
+    f, buf, deadline, last, ended = None, bytearray(), None, 0.0, None
     try:
-        # change directory, fork and execute the task.
-        os.chdir(task.cwd)
-        cmd = shlex.split(task.cmd)
-        log.info(f'worker[{os.getpid()}]: Command: {str(cmd)}')
-        proc = subprocess.Popen(
-            cmd, shell=False, stdin=None,
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=task.cwd)
-        # override daemon's sigaction handler
-        def sigterm_handler(signo, frame):
-            log.info(f'worker[{os.getpid()}] recieved SIGTERM. Gracefully pulling down task process...')
-            proc.kill()
-            os._exit(0)
-        signal.signal(signal.SIGTERM, sigterm_handler)
-        # override daemon's atexit action
-        atexit.register(lambda: None)
-        # If nothing goes wrong, we'll get the content of stdout and stderr
-        stdout, _ = proc.communicate()
-        retval = proc.returncode
-    except FileNotFoundError as e:
-        log.error(f'worker[{os.getpid()}]: {str(e)}')
-        stdout, retval = '', '', -1
+        fd = spool.fileno()
+        while True:
+            # (checked before reading, so that nothing written before is missed)
+            finished = done is None or done.is_set()
+            data = os.read(fd, 65536)
+            now = time.time()
+            if data:
+                last = now
+                buf += data
+                if tail is not None:
+                    tail += data
+                    del tail[:-65536]
+                if deadline is None:
+                    deadline = now + interval
+            if buf and (len(buf) >= chunk or now >= deadline
+                        or (finished and not data)):
+                if f is None:
+                    f = open(path, 'ab')
+                f.write(zstd.compress(bytes(buf)))
+                f.flush()
+                buf.clear()
+                deadline = None
+            if data:
+                continue
+            if done is None:
+                break  # EOF
+            if finished:
+                ended = ended or now
+                if now - max(last, ended) >= linger:
+                    break
+                time.sleep(min(poll, linger))
+            else:
+                done.wait(poll if deadline is None else
+                          max(0.0, min(poll, deadline - now)))
     except Exception as e:
-        log.error(f'worker[{os.getpid()}]: {str(e)}')
-        stdout, retval = '', '', -1
+        log.error(f'output[{task.id}]: {str(e)}')
     finally:
-        log.info(f'worker[{os.getpid()}]: subprocess.Popen() successfully returned.')
-    # write the stdout (stderr was redirected here)
-    os.chdir(defs.TASQUE_DIR)
-    timestamp = time.strftime('%Y%m%d.%H%M%S')
-    if len(stdout) > 0:
-        with open(f'tq_id-{task.id}_{timestamp}.stdout.zst', 'wb') as f:
-            f.write(zstd.dumps(stdout))
-    # update database after finishing the task
-    sql = f"update tq set retval = {retval}, etime = {time.time()}, pid = null where (id = {task.id})"
-    log.info(f'worker[{os.getpid()}]: SQL(post-task) -- {sql}')
-    db(sql)
-    # END
-    log.info(f'worker[{os.getpid()}]: end gracefully.')
+        spool.close()
+        if f is not None:
+            f.close()
@@ -3,96 +3,466 @@ Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
 License: MIT/Expat
 '''
 
+import contextlib
+import json
+import math
 import os
 import re
 import sqlite3
 import sys
 import rich
 import pathlib
+from typing import Iterable, Iterator, List
 from . import defs
 from . import resources
 from . import utils
 
 
+# sqlite3 connections must not be used across fork(), and must not be closed
+# in the child either (closing may checkpoint/unlink the WAL of the parent).
+# Inherited connections are parked here so that they are never finalized.
+_INHERITED_CONNECTIONS = []
+
+
+# Indexes of the current schema.
+INDEXES = (
+    f'CREATE INDEX IF NOT EXISTS tq_state_pri_id'
+    + f' ON {defs.DB_TABLE_TASQUE} (state, pri DESC, id)',
+    f'CREATE INDEX IF NOT EXISTS notes_id ON {defs.DB_TABLE_NOTES} (id)',
+    f'CREATE INDEX IF NOT EXISTS samples_id_time'
+    + f' ON {defs.DB_TABLE_SAMPLES} (id, time)',
+    )
+
+# MIGRATIONS[v] upgrades the database schema from version v to v+1.
+MIGRATIONS = (
+    # 0 -> 1: unify 'null' strings into NULL. explicit task state.
+    [f'UPDATE {defs.DB_TABLE_TASQUE} SET {col} = NULL WHERE ({col} = "null")'
+        for col in ('pid', 'retval', 'stime', 'etime')] + [
+    f'ALTER TABLE {defs.DB_TABLE_TASQUE} ADD COLUMN state',
+    f'''UPDATE {defs.DB_TABLE_TASQUE} SET state = CASE
+        WHEN (retval IS NOT NULL) AND (retval = 0) THEN 'done'
+        WHEN (retval IS NOT NULL) THEN 'failed'
+        WHEN (pid IS NULL) THEN 'pending'
+        WHEN (pid < 0) THEN 'accident'
+        ELSE 'running' END''',
+    ],
+    # 1 -> 2: ids are assigned by sqlite. (tables have to be rebuilt)
+    [f'CREATE TABLE tq_ (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        + ' pid, cwd, cmd, retval, stime, etime, pri, rsc, state)',
+    'INSERT INTO tq_ SELECT id, pid, cwd, cmd, retval, stime, etime,'
+        + ' pri, rsc, state FROM tq',
+    'DROP TABLE tq',
+    'ALTER TABLE tq_ RENAME TO tq',
+    'CREATE TABLE notes_ (noteid INTEGER PRIMARY KEY AUTOINCREMENT, id, note)',
+    'INSERT INTO notes_ SELECT noteid, id, note FROM notes',
+    'DROP TABLE notes',
+    'ALTER TABLE notes_ RENAME TO notes',
+    ],
+    # 2 -> 3: archive of finished tasks
+    ['CREATE TABLE archive (id INTEGER PRIMARY KEY, pid, cwd, cmd, retval,'
+        + ' stime, etime, pri, rsc, state, notes)',
+    ],
+    # 3 -> 4: vector resource requests, as JSON (e.g. {"cpu": 2, "vmem": 6000})
+    ['ALTER TABLE tq ADD COLUMN rscv',
+    ],
+    # 4 -> 5: resource usage accounting
+    ['CREATE TABLE usage (id INTEGER PRIMARY KEY, utime, systime, maxrss,'
+        + ' inblock, oublock, nvcsw, nivcsw)',
+    ],
+    # 5 -> 6: telemetry samples of running tasks
+    ['CREATE TABLE samples (id, time, cpu, rss, vmem)',
+    ],
+    # 6 -> 7: usage history for resource estimation
+    ['CREATE TABLE history (cwd, cmd, runs, rss, vmem, cpu,'
+        + ' PRIMARY KEY (cwd, cmd))',
+    ],
+    # 7 -> 8: python tasks run from a warm template ("module:func")
+    ['ALTER TABLE tq ADD COLUMN entry',
+    ],
+    # 8 -> 9: environment of the submitters
+    ['CREATE TABLE env (id INTEGER PRIMARY KEY, env)',
+    ],
+    # 9 -> 10: allocation ledger of the running tasks
+    ['CREATE TABLE alloc (id INTEGER PRIMARY KEY, pid, pstart, output, placement)',
+    ],
+    # 10 -> 11: retry policies, and the attempts of each task
+    ['CREATE TABLE retry (id INTEGER PRIMARY KEY, attempts, backoff, codes, pattern)',
+    'CREATE TABLE attempts (id, attempt, pid, retval, stime, etime,'
+        + ' PRIMARY KEY (id, attempt))',
+    ],
+    # 11 -> 12: result memoization
+    ['CREATE TABLE memo (id INTEGER PRIMARY KEY, inputs, env, key)',
+    'CREATE TABLE cache (key PRIMARY KEY, id, output, time)',
+    'CREATE TABLE hashes (path PRIMARY KEY, mtime, size, digest)',
+    ],
+    )
+assert(len(MIGRATIONS) == defs.SCHEMA_VERSION)
+
+
+# The namedtuple type for rows of each table.
+_RECORDS = {
+    defs.DB_TABLE_CONFIG: defs.Config,
+    defs.DB_TABLE_TASQUE: defs.Task,
+    defs.DB_TABLE_NOTES: defs.Note,
+    defs.DB_TABLE_ARCHIVE: defs.Archived,
+    defs.DB_TABLE_USAGE: defs.Usage,
+    defs.DB_TABLE_SAMPLES: defs.Sample,
+    defs.DB_TABLE_HISTORY: defs.History,
+    defs.DB_TABLE_ENV: defs.Env,
+    defs.DB_TABLE_ALLOC: defs.Alloc,
+    defs.DB_TABLE_RETRY: defs.Retry,
+    defs.DB_TABLE_ATTEMPTS: defs.Attempt,
+    defs.DB_TABLE_MEMO: defs.Memo,
+    defs.DB_TABLE_CACHE: defs.Cached,
+    defs.DB_TABLE_HASHES: defs.Hash,
+    }
+
+
+def _marks(record: type) -> str:
+    '''
+    SQL parameter placeholders for all fields of a namedtuple type.
+    '''
+    return ', '.join('?' * len(record._fields))
+
+
 class tqDB:
-    def __init__(self, dbpath: str):
+    def __init__(self, dbpath: str, *, timeout: float = 30.0):
         self.dbpath = dbpath
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
         self.create()
 
+    def __getstate__(self) -> dict:
+        # connections cannot be pickled. the receiver will reconnect.
+        state = self.__dict__.copy()
+        state['_conn'], state['_pid'] = None, None
+        return state
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Open a new connection to the database. The database is switched
+        into WAL mode so that readers (e.g. tq ls) do not block the writer,
+        and the busy timeout makes concurrent writers wait for the lock
+        instead of failing immediately with "database is locked".
+        '''
+        conn = sqlite3.connect(self.dbpath, timeout=self.timeout)
+        conn.execute(f'PRAGMA busy_timeout = {int(self.timeout * 1000)}')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        '''
+        The long-lived connection of the current process. It is lazily
+        (re)opened, in particular after fork() in the worker processes.
+        '''
+        if self._conn is None or self._pid != os.getpid():
+            if self._conn is not None:
+                _INHERITED_CONNECTIONS.append(self._conn)
+            self._conn = self.connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self) -> None:
+        '''
+        Close the connection owned by the current process, if any.
+        '''
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn, self._pid = None, None
+
     def create(self) -> None:
         '''
         Create a sqlite3 database for Tq Daemon use.
         '''
         if os.path.exists(self.dbpath):
-            return None
+            return self.migrate()
         path = pathlib.Path(self.dbpath).parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(self.dbpath)
+        conn = self.conn
         sql = f'CREATE TABLE {defs.DB_TABLE_CONFIG} ({defs.CONFIG_FIELDS})'
         conn.execute(sql)
-        sql = f'CREATE TABLE {defs.DB_TABLE_TASQUE} ({defs.TASK_FIELDS})'
+        sql = f'CREATE TABLE {defs.DB_TABLE_TASQUE} ({defs.TASK_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_NOTES} ({defs.NOTE_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_ARCHIVE} ({defs.ARCHIVE_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_USAGE} ({defs.USAGE_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_SAMPLES} ({defs.SAMPLE_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_HISTORY} ({defs.HISTORY_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_ENV} ({defs.ENV_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_ALLOC} ({defs.ALLOC_SCHEMA})'
         conn.execute(sql)
-        sql = f'CREATE TABLE {defs.DB_TABLE_NOTES} ({defs.NOTE_FIELDS})'
+        sql = f'CREATE TABLE {defs.DB_TABLE_RETRY} ({defs.RETRY_SCHEMA})'
         conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_ATTEMPTS} ({defs.ATTEMPT_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_MEMO} ({defs.MEMO_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_CACHE} ({defs.CACHE_SCHEMA})'
+        conn.execute(sql)
+        sql = f'CREATE TABLE {defs.DB_TABLE_HASHES} ({defs.HASH_SCHEMA})'
+        conn.execute(sql)
+        for sql in INDEXES:
+            conn.execute(sql)
         conn.commit()
-        conn.close()
         # insert configurations
-        self.exec(f'INSERT INTO {defs.DB_TABLE_CONFIG} ({defs.CONFIG_FIELDS})'
-                + f' VALUES ("resource", "{resources.RESOURCE_DEFAULT}")')
+        self.executemany(f'INSERT INTO {defs.DB_TABLE_CONFIG}'
+                + f' ({defs.CONFIG_FIELDS}) VALUES (?, ?)',
+                [('resource', resources.RESOURCE_DEFAULT),
+                 ('schema', defs.SCHEMA_VERSION)])
 
-    def exec(self, sql: str) -> None:
+    def version(self) -> int:
+        '''
+        Schema version of the database. 0 for the unversioned schema.
+        '''
+        R = self[f'SELECT value FROM {defs.DB_TABLE_CONFIG} WHERE (key = ?)',
+                ('schema',)]
+        return int(R[0][0]) if R else 0
+
+    def migrate(self) -> None:
+        '''
+        Upgrade an existing database to the current schema version.
+        '''
+        if self.version() >= defs.SCHEMA_VERSION:
+            return None
+        # check again with the write lock held: we may have lost a race.
+        with self.transaction() as conn:
+            version = self.version()
+            for migration in MIGRATIONS[version:]:
+                for sql in migration:
+                    conn.execute(sql)
+            for sql in INDEXES:
+                conn.execute(sql)
+            conn.execute(f'DELETE FROM {defs.DB_TABLE_CONFIG} WHERE (key = ?)',
+                    ('schema',))
+            conn.execute(f'INSERT INTO {defs.DB_TABLE_CONFIG}'
+                    + f' ({defs.CONFIG_FIELDS}) VALUES (?, ?)',
+                    ('schema', defs.SCHEMA_VERSION))
+
+    @contextlib.contextmanager
+    def transaction(self) -> sqlite3.Connection:
+        '''
+        A write transaction that holds the database lock from the beginning.
+        Commits on success and rolls back on exception.
+        '''
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def archive(self, before: float = None) -> int:
+        '''
+        Move finished tasks, and their notes, into the archive table in one
+        transaction. When <before> (seconds since epoch) is given, only tasks
+        that finished earlier than that are archived.
+        Returns the number of archived tasks.
+        '''
+        fields = defs.ARCHIVE_FIELDS.replace(', notes', '')
+        sql = f'SELECT {fields} FROM {defs.DB_TABLE_TASQUE}' \
+                + ' WHERE (state IN (?, ?))'
+        params = ('done', 'failed')
+        if before is not None:
+            sql += ' AND (etime < ?)'
+            params += (before,)
+        with self.transaction() as conn:
+            tasks = conn.execute(sql, params).fetchall()
+            rows = []
+            for task in tasks:
+                notes = conn.execute(f'SELECT note FROM {defs.DB_TABLE_NOTES}'
+                        + ' WHERE (id = ?) ORDER BY noteid', (task[0],))
+                rows.append(task + (utils.packnotes([n for (n,) in notes]),))
+            conn.executemany(f'INSERT OR REPLACE INTO {defs.DB_TABLE_ARCHIVE}'
+                    + f' ({defs.ARCHIVE_FIELDS})'
+                    + f' VALUES ({_marks(defs.Archived)})', rows)
+            ids = [(task[0],) for task in tasks]
+            conn.executemany(f'DELETE FROM {defs.DB_TABLE_NOTES}'
+                    + ' WHERE (id = ?)', ids)
+            conn.executemany(f'DELETE FROM {defs.DB_TABLE_ENV}'
+                    + ' WHERE (id = ?)', ids)
+            conn.executemany(f'DELETE FROM {defs.DB_TABLE_RETRY}'
+                    + ' WHERE (id = ?)', ids)
+            conn.executemany(f'DELETE FROM {defs.DB_TABLE_MEMO}'
+                    + ' WHERE (id = ?)', ids)
+            conn.executemany(f'DELETE FROM {defs.DB_TABLE_TASQUE}'
+                    + ' WHERE (id = ?)', ids)
+        return len(tasks)
+
+    def downsample(self, before: float, bucket: float,
+            expire: float = None) -> int:
+        '''
+        Merge the samples taken earlier than <before> into one sample per
+        task and <bucket> seconds (mean CPU, peak RSS and GPU memory), and
+        delete the samples older than <expire>. Only complete buckets are
+        merged, so every bucket is merged at most once.
+        Returns the number of merged buckets.
+        '''
+        before = math.floor(before / bucket) * bucket
+        table = defs.DB_TABLE_SAMPLES
+        with self.transaction() as conn:
+            if expire is not None:
+                conn.execute(f'DELETE FROM {table} WHERE (time < ?)', (expire,))
+            merged = conn.execute(f'''SELECT id,
+                    CAST(time / ? AS INTEGER) * ? AS bucket,
+                    avg(cpu), max(rss), max(vmem) FROM {table}
+                    WHERE (time < ?) GROUP BY id, bucket
+                    HAVING count(*) > 1''', (bucket, bucket, before)).fetchall()
+            conn.executemany(f'DELETE FROM {table} WHERE (id = ?)'
+                    + ' AND (time >= ?) AND (time < ? + ?)',
+                    [(x[0], x[1], x[1], bucket) for x in merged])
+            conn.executemany(f'INSERT INTO {table} ({defs.SAMPLE_FIELDS})'
+                    + f' VALUES ({_marks(defs.Sample)})', merged)
+        return len(merged)
+
+    def execute(self, sql: str, params: Iterable = ()) -> sqlite3.Cursor:
+        '''
+        Execute a (parameterized) SQL statement in its own transaction.
+        '''
+        with self.conn as conn:
+            return conn.execute(sql, tuple(params))
+
+    def executemany(self, sql: str, rows: Iterable) -> sqlite3.Cursor:
+        '''
+        Execute a parameterized SQL statement over many rows. All rows are
+        written in a single transaction with one prepared statement.
+        '''
+        with self.conn as conn:
+            return conn.executemany(sql, rows)
+
+    def exec(self, sql: str, params: Iterable = ()) -> None:
         '''
         Execute a SQL statement on a given DB file.
         '''
-        conn = sqlite3.connect(self.dbpath)
-        conn.execute(sql)
-        conn.commit()
-        conn.close()
+        self.execute(sql, params)
+
+    def __call__(self, sql: str, params: Iterable = ()) -> None:
+        self.exec(sql, params)
 
-    def __call__(self, sql: str) -> None:
-        self.exec(sql)
+    def _insert(self, sql: str, rows: Iterable) -> List[int]:
+        # one transaction, one prepared statement, and we collect the rowids
+        with self.conn as conn:
+            return [conn.execute(sql, tuple(row)).lastrowid for row in rows]
+
+    def insert_tasks(self, tasks: Iterable[defs.Task],
+            envs: Iterable[dict] = None,
+            retries: Iterable[defs.Retry] = None,
+            memos: Iterable[defs.Memo] = None) -> List[int]:
+        '''
+        Bulk insertion of tasks in one transaction. Tasks with id None get
+        their id assigned by sqlite. Returns the list of task ids.
+        <envs>, if given, are the environments to run the tasks with (one
+        dict or None per task), <retries> their retry policies and <memos>
+        their memoization specs (one record, whose id is ignored, or None
+        per task), stored along in the same transaction.
+        '''
+        sql = f'INSERT INTO {defs.DB_TABLE_TASQUE}' \
+                + f' ({defs.TASK_FIELDS}) VALUES ({_marks(defs.Task)})'
+        if envs is None and retries is None and memos is None:
+            return self._insert(sql, tasks)
+        tasks = list(tasks)
+        envs = [None] * len(tasks) if envs is None else envs
+        retries = [None] * len(tasks) if retries is None else retries
+        memos = [None] * len(tasks) if memos is None else memos
+        ids = []
+        with self.conn as conn:
+            for task, env, retry, memo in zip(tasks, envs, retries, memos):
+                ids.append(conn.execute(sql, tuple(task)).lastrowid)
+                if env is not None:
+                    conn.execute(f'INSERT INTO {defs.DB_TABLE_ENV}'
+                            + f' ({defs.ENV_FIELDS}) VALUES (?, ?)',
+                            (ids[-1], json.dumps(env)))
+                if retry is not None:
+                    conn.execute(f'INSERT INTO {defs.DB_TABLE_RETRY}'
+                            + f' ({defs.RETRY_FIELDS})'
+                            + f' VALUES ({_marks(defs.Retry)})',
+                            retry._replace(id=ids[-1]))
+                if memo is not None:
+                    conn.execute(f'INSERT INTO {defs.DB_TABLE_MEMO}'
+                            + f' ({defs.MEMO_FIELDS})'
+                            + f' VALUES ({_marks(defs.Memo)})',
+                            memo._replace(id=ids[-1]))
+        return ids
+
+    def environ(self, taskid: int) -> dict:
+        '''
+        The recorded environment of a task, or None.
+        '''
+        R = self[f'SELECT env FROM {defs.DB_TABLE_ENV} WHERE (id = ?)', (taskid,)]
+        return json.loads(R[0][0]) if R else None
+
+    def insert_notes(self, notes: Iterable[defs.Note]) -> List[int]:
+        '''
+        Bulk insertion of notes in one transaction. Notes with noteid None get
+        their id assigned by sqlite. Returns the list of note ids.
+        '''
+        return self._insert(f'INSERT INTO {defs.DB_TABLE_NOTES}'
+                + f' ({defs.NOTE_FIELDS}) VALUES ({_marks(defs.Note)})',
+                map(utils.null2none, notes))
 
     def __iadd__(self, item: object) -> object:
         if isinstance(item, str):
             self.exec(item)
         elif isinstance(item, defs.Task):
-            values = ','.join(map(repr, utils.none2null(item)))
-            self.exec(f'''INSERT INTO
-                    {defs.DB_TABLE_TASQUE} ({defs.TASK_FIELDS})
-                    VALUES ({values})'''.replace('\n', ' '))
+            self.insert_tasks([item])
         elif isinstance(item, defs.Note):
-            values = ','.join(map(repr, utils.null2none(item)))
-            self.exec(f'''INSERT INTO
-                    {defs.DB_TABLE_NOTES} ({defs.NOTE_FIELDS})
-                    VALUES ({values})'''.replace('\n', ' '))
+            self.insert_notes([item])
         else:
             raise TypeError('unknown type')
         return self
 
-    def query(self, sql: str) -> list:
+    def iter(self, sql: str, params: Iterable = (), *,
+            batch: int = 256) -> Iterator[tuple]:
+        '''
+        Stream the results of a query, fetching <batch> rows at a time.
+        Unlike query(), memory usage does not grow with the result size.
+        '''
+        if not isinstance(sql, str):
+            raise TypeError('expected SQL string here')
+        if sql in _RECORDS:
+            yield from map(_RECORDS[sql]._make,
+                    self.iter(f'select * from {sql}', batch=batch))
+            return
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, tuple(params))
+            while True:
+                values = cursor.fetchmany(batch)
+                if not values:
+                    break
+                yield from map(utils.null2none, values)
+        finally:
+            cursor.close()
+
+    def query(self, sql: str, params: Iterable = ()) -> list:
         '''
         Query from DB
         '''
         if not isinstance(sql, str):
             raise TypeError('expected SQL string here')
-        if sql == defs.DB_TABLE_TASQUE:
-            return list(map(lambda T: defs.Task._make(utils.null2none(T)),
-                self[f'select * from {defs.DB_TABLE_TASQUE}']))
-        elif sql == defs.DB_TABLE_NOTES:
-            return list(map(lambda T: defs.Note._make(utils.null2none(T)),
-                self[f'select * from {defs.DB_TABLE_NOTES}']))
-        elif sql == defs.DB_TABLE_CONFIG:
-            return list(map(lambda T: defs.Config._make(utils.null2none(T)),
-                self[f'select * from {defs.DB_TABLE_CONFIG}']))
-        conn = sqlite3.connect(self.dbpath)
-        cursor = conn.cursor()
-        cursor.execute(sql)
+        if sql in _RECORDS:
+            return list(self.iter(sql))
+        cursor = self.conn.cursor()
+        cursor.execute(sql, tuple(params))
         values = cursor.fetchall()  # len(values) may be 0
         cursor.close()
-        conn.close()
         values = list(map(utils.null2none, values))
         return values
 
-    def __getitem__(self, sql: str) -> list:
+    def __getitem__(self, sql: object) -> list:
+        # db[sql] or db[sql, params]
+        if isinstance(sql, tuple):
+            return self.query(*sql)
         return self.query(sql)
 
 
@@ -101,9 +471,8 @@ class tqDB:
         Dump database to screen. Raw version of tqLS.
         '''
         c = rich.get_console()
-        c.log('dumping configurations')
-        c.print(self[defs.DB_TABLE_CONFIG])
-        c.log('dumping tasks')
-        c.print(self[defs.DB_TABLE_TASQUE])
-        c.log('dumping notes')
-        c.print(self[defs.DB_TABLE_NOTES])
+        for table in (defs.DB_TABLE_CONFIG, defs.DB_TABLE_TASQUE,
+                defs.DB_TABLE_NOTES):
+            c.log(f'dumping {table}')
+            for record in self.iter(table):
+                c.print(record)
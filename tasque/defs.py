@@ -12,13 +12,92 @@ CONFIG_FIELDS = 'key, value'
 Config = namedtuple('Config', CONFIG_FIELDS)
 
 DB_TABLE_TASQUE = 'tq'
-TASK_FIELDS = 'id, pid, cwd, cmd, retval, stime, etime, pri, rsc'
-Task = namedtuple('Task', TASK_FIELDS)
+TASK_FIELDS = 'id, pid, cwd, cmd, retval, stime, etime, pri, rsc, state, rscv, entry'
+# the trailing fields are optional
+Task = namedtuple('Task', TASK_FIELDS, defaults=(None, None))
+TASK_SCHEMA = TASK_FIELDS.replace('id', 'id INTEGER PRIMARY KEY AUTOINCREMENT', 1)
+TASK_STATES = ('pending', 'running', 'done', 'failed', 'accident')
 
 DB_TABLE_NOTES = 'notes'
 NOTE_FIELDS = 'noteid, id, note'
+NOTE_SCHEMA = NOTE_FIELDS.replace('noteid', 'noteid INTEGER PRIMARY KEY AUTOINCREMENT', 1)
 Note = namedtuple('Note', NOTE_FIELDS)
 
+DB_TABLE_ARCHIVE = 'archive'
+ARCHIVE_FIELDS = 'id, pid, cwd, cmd, retval, stime, etime, pri, rsc, state, notes'
+ARCHIVE_SCHEMA = ARCHIVE_FIELDS.replace('id', 'id INTEGER PRIMARY KEY', 1)
+Archived = namedtuple('Archived', ARCHIVE_FIELDS)
+
+# resource usage of finished tasks (see getrusage(2)), for both tq and archive
+DB_TABLE_USAGE = 'usage'
+USAGE_FIELDS = 'id, utime, systime, maxrss, inblock, oublock, nvcsw, nivcsw'
+USAGE_SCHEMA = USAGE_FIELDS.replace('id', 'id INTEGER PRIMARY KEY', 1)
+Usage = namedtuple('Usage', USAGE_FIELDS)
+
+# periodic samples of running tasks: CPU utilization (cores), RSS (MB) and
+# GPU memory (MB) of the process tree
+DB_TABLE_SAMPLES = 'samples'
+SAMPLE_FIELDS = 'id, time, cpu, rss, vmem'
+SAMPLE_SCHEMA = SAMPLE_FIELDS
+Sample = namedtuple('Sample', SAMPLE_FIELDS)
+
+# peak usage of successful tasks, per (cwd, normalized cmd): RSS (MB),
+# GPU memory (MB), CPU utilization (cores). For resource estimation.
+DB_TABLE_HISTORY = 'history'
+HISTORY_FIELDS = 'cwd, cmd, runs, rss, vmem, cpu'
+HISTORY_SCHEMA = HISTORY_FIELDS + ', PRIMARY KEY (cwd, cmd)'
+History = namedtuple('History', HISTORY_FIELDS)
+
+# environment of the submitter of a task (JSON), until the task is archived
+DB_TABLE_ENV = 'env'
+ENV_FIELDS = 'id, env'
+ENV_SCHEMA = ENV_FIELDS.replace('id', 'id INTEGER PRIMARY KEY', 1)
+Env = namedtuple('Env', ENV_FIELDS)
+
+# allocation ledger: the running tasks, their process (pid and start time),
+# their output file, and their resource placement (JSON)
+DB_TABLE_ALLOC = 'alloc'
+ALLOC_FIELDS = 'id, pid, pstart, output, placement'
+ALLOC_SCHEMA = ALLOC_FIELDS.replace('id', 'id INTEGER PRIMARY KEY', 1)
+Alloc = namedtuple('Alloc', ALLOC_FIELDS)
+
+# retry policy of a task, over the config['retry_*'] defaults: total number
+# of attempts, initial backoff (seconds, doubling), comma-separated exit
+# codes and regular expression on the output that qualify for a retry
+DB_TABLE_RETRY = 'retry'
+RETRY_FIELDS = 'id, attempts, backoff, codes, pattern'
+RETRY_SCHEMA = RETRY_FIELDS.replace('id', 'id INTEGER PRIMARY KEY', 1)
+Retry = namedtuple('Retry', RETRY_FIELDS)
+
+# every run of a task, including the ones that were retried
+DB_TABLE_ATTEMPTS = 'attempts'
+ATTEMPT_FIELDS = 'id, attempt, pid, retval, stime, etime'
+ATTEMPT_SCHEMA = ATTEMPT_FIELDS + ', PRIMARY KEY (id, attempt)'
+Attempt = namedtuple('Attempt', ATTEMPT_FIELDS)
+
+# opt-in result memoization of a task: the input files (JSON list of globs,
+# relative to its cwd) and environment variables (JSON list of names) its
+# result depends on, and its key once computed by the daemon
+DB_TABLE_MEMO = 'memo'
+MEMO_FIELDS = 'id, inputs, env, key'
+MEMO_SCHEMA = MEMO_FIELDS.replace('id', 'id INTEGER PRIMARY KEY', 1)
+Memo = namedtuple('Memo', MEMO_FIELDS)
+
+# successful runs by memo key: the task and its output file
+DB_TABLE_CACHE = 'cache'
+CACHE_FIELDS = 'key, id, output, time'
+CACHE_SCHEMA = CACHE_FIELDS.replace('key', 'key PRIMARY KEY', 1)
+Cached = namedtuple('Cached', CACHE_FIELDS)
+
+# content hashes (sha256) of input files, valid for (mtime in ns, size)
+DB_TABLE_HASHES = 'hashes'
+HASH_FIELDS = 'path, mtime, size, digest'
+HASH_SCHEMA = HASH_FIELDS.replace('path', 'path PRIMARY KEY', 1)
+Hash = namedtuple('Hash', HASH_FIELDS)
+
+# Version of the database schema. Stored in the config table.
+SCHEMA_VERSION = 12
+
 # TASQUE_DB is the key variable.
 if os.getenv('TASQUE_DB') is not None:
     TASQUE_DB = os.path.expanduser(os.getenv('TASQUE_DB'))
@@ -29,3 +108,4 @@ else:
 TASQUE_DIR = os.path.dirname(TASQUE_DB)
 TASQUE_LOG = os.path.join(TASQUE_DIR, 'tasq.log')
 TASQUE_PID = os.path.join(TASQUE_DIR, 'tasque.pid')
+TASQUE_SOCK = os.path.join(TASQUE_DIR, 'tasque.sock')
@@ -0,0 +1,274 @@
+'''
+Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
+License: MIT/Expat
+
+Warm template processes for python tasks. A template imports the configured
+modules once, and then forks a child for every python task (given as a
+"module:func" entry point), so that the tasks skip the interpreter startup
+and the expensive imports (e.g. torch).
+
+The daemon talks to a template over a SOCK_SEQPACKET socket pair with json
+messages. Requests carry the stdout of the task as an SCM_RIGHTS fd:
+    daemon -> template: {"entry": ..., "argv": [...], "cwd": ..., "env": {...},
+                         "status": ...}
+    template -> daemon: {"event": "ready"}  (once the modules are imported)
+                        {"event": "spawned", "pid": ...}
+                        {"event": "error", "error": ...}
+                        {"event": "exited", "pid": ..., "status": ..., "rusage": {...}}
+The tasks are children of the template, so the template reaps them and
+forwards their exit status. It also records it into the status file of the
+task (see wrapper), and outlives the daemon until its tasks have exited, so
+that a restarted daemon still learns how they ended.
+'''
+
+from typing import *
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+import traceback
+import types
+from .wrapper import writestatus
+
+_RUSAGE = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock', 'ru_oublock',
+        'ru_nvcsw', 'ru_nivcsw')
+
+
+class tqForkServer:
+    '''
+    Daemon side of a template process.
+    '''
+
+    def __init__(self, modules: List[str]):
+        self.modules = list(modules)
+        self.sock, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.proc = subprocess.Popen([sys.executable, '-c',
+            'import sys; from tasque.forkserver import main; main(sys.argv[1:])',
+            str(theirs.fileno())] + self.modules, pass_fds=(theirs.fileno(),),
+            stdin=subprocess.DEVNULL)
+        theirs.close()
+        # pid -> (wait status, rusage) of the exited tasks
+        self.exited = dict()
+        self.dead, self.ready = False, False
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def alive(self) -> bool:
+        return not self.dead and self.proc.poll() is None
+
+    def _recv(self, block: bool = True) -> dict:
+        self.sock.setblocking(block)
+        try:
+            msg = self.sock.recv(65536)
+        except BlockingIOError:
+            return None
+        if not msg:
+            self.dead = True
+            return None
+        msg = json.loads(msg)
+        if msg['event'] == 'ready':
+            self.ready = True
+        elif msg['event'] == 'exited':
+            ru = types.SimpleNamespace(**msg['rusage'])
+            self.exited[msg['pid']] = (msg['status'], ru)
+        return msg
+
+    def poll(self) -> None:
+        '''
+        Collect the pending exit notifications, without blocking.
+        '''
+        while not self.dead and self._recv(block=False) is not None:
+            pass
+
+    def spawn(self, entry: str, argv: List[str], cwd: str, stdout: int,
+            env: dict = None, timeout: float = 30.0, status: str = None,
+            cpus: List[int] = None) -> int:
+        '''
+        Fork a child running entry ("module:func") with sys.argv[1:] = argv,
+        whose stdout and stderr go to the <stdout> fd. <env> replaces the
+        environment of the child, which is pinned to the <cpus> cores if
+        given. Its exit status is recorded into the <status> file, if
+        given. Returns its pid.
+
+        The answer comes quickly from a ready template (see self.ready).
+        A template that does not answer within <timeout> seconds is killed.
+        '''
+        request = dict(entry=entry, argv=list(argv), cwd=cwd, env=env or {},
+                status=status, cpus=list(cpus) if cpus else None)
+        socket.send_fds(self.sock, [json.dumps(request).encode()], [stdout])
+        deadline = time.time() + timeout
+        while True:
+            if not select.select([self.sock], [], [], max(0.0, deadline - time.time()))[0]:
+                self.proc.kill()
+                self.dead = True
+                raise OSError(f'the template process did not answer in {timeout}s')
+            msg = self._recv(block=True)
+            if msg is None:
+                raise OSError('the template process is gone')
+            if msg['event'] == 'spawned':
+                return msg['pid']
+            if msg['event'] == 'error':
+                raise OSError(msg['error'])
+
+    def wait4(self, pid: int, options: int = 0) -> (int, int, object):
+        '''
+        Like os.wait4() for the children of the template. The status is
+        None if the template died without telling the exit status.
+        '''
+        while pid not in self.exited:
+            if self.dead:
+                if os.path.exists(f'/proc/{pid}'):
+                    return 0, 0, None
+                return pid, None, None
+            if options & os.WNOHANG:
+                self.poll()
+                if pid not in self.exited:
+                    return 0, 0, None
+            else:
+                self._recv(block=True)
+        status, ru = self.exited.pop(pid)
+        return pid, status, ru
+
+    def close(self, wait: bool = True) -> None:
+        '''
+        Let the template go. Without <wait>, it is left to finish with its
+        running tasks (see main).
+        '''
+        self.sock.close()
+        if not wait:
+            return
+        try:
+            self.proc.wait(timeout=3)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def _child(request: dict, stdout: int) -> None:
+    '''
+    Run a python task in a forked child of the template. Never returns.
+    '''
+    code = 1
+    try:
+        os.chdir(request['cwd'])
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(stdout, 1)
+        os.dup2(stdout, 2)
+        os.close(devnull)
+        os.close(stdout)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        if request.get('cpus'):
+            # before the task code runs, so that its threads inherit it
+            os.sched_setaffinity(0, request['cpus'])
+        module, func = request['entry'].split(':', 1)
+        sys.argv = [request['entry']] + request['argv']
+        ret = getattr(importlib.import_module(module), func)()
+        code = ret if isinstance(ret, int) else 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for f in (sys.stdout, sys.stderr):
+            try:
+                f.flush()
+            except Exception:
+                pass
+        os._exit(code)
+
+
+def main(argv: List[str]) -> None:
+    '''
+    Template process. argv: <fd of the socket> [modules to import ...]
+    '''
+    sock = socket.socket(fileno=int(argv[0]))
+    for module in argv[1:]:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print(f'forkserver[{os.getpid()}]: cannot import {module}: {e}',
+                    file=sys.stderr)
+    sigr, sigw = socket.socketpair()
+    sigr.setblocking(False)
+    sigw.setblocking(False)
+    signal.set_wakeup_fd(sigw.fileno(), warn_on_full_buffer=False)
+    signal.signal(signal.SIGCHLD, lambda signo, frame: None)
+    sock.send(json.dumps(dict(event='ready')).encode())
+    # pid -> status file of the running tasks. Once the daemon is gone
+    # (sock is None), we stay until they exit, to record their status.
+    children = dict()
+    while sock is not None or children:
+        ready, _, _ = select.select([x for x in (sock, sigr) if x is not None], [], [])
+        if sigr in ready:
+            while True:
+                try:
+                    sigr.recv(4096)
+                except BlockingIOError:
+                    break
+            while True:
+                try:
+                    pid, status, ru = os.wait4(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                path = children.pop(pid, None)
+                if path:
+                    try:
+                        writestatus(path, status, ru)
+                    except OSError as e:
+                        print(f'forkserver[{os.getpid()}]: {e}', file=sys.stderr)
+                if sock is None:
+                    continue
+                try:
+                    sock.send(json.dumps(dict(event='exited', pid=pid, status=status,
+                        rusage={k: getattr(ru, k) for k in _RUSAGE})).encode())
+                except OSError:
+                    sock = None
+        if sock is not None and sock in ready:
+            try:
+                msg, fds, flags, _ = socket.recv_fds(sock, 65536, 1)
+            except ConnectionError:
+                msg, fds = b'', []
+            if not msg:
+                sock = None  # the daemon is gone
+                continue
+            try:
+                if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC) or len(fds) != 1:
+                    raise ValueError(f'malformed request ({len(fds)} fds, flags {flags})')
+                request = json.loads(msg)
+            except ValueError as e:
+                for fd in fds:
+                    os.close(fd)
+                sock.send(json.dumps(dict(event='error', error=str(e))).encode())
+                continue
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                pid = os.fork()
+            except OSError as e:
+                os.close(fds[0])
+                sock.send(json.dumps(dict(event='error', error=str(e))).encode())
+                continue
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                sock.close()
+                sigr.close()
+                sigw.close()
+                _child(request, fds[0])
+            os.close(fds[0])
+            children[pid] = request.get('status')
+            sock.send(json.dumps(dict(event='spawned', pid=pid)).encode())
+
@@ -3,10 +3,13 @@ Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
 License: MIT/Expat
 '''
 
+from typing import *
 import os
 import math
 import time
 import random
+import re
+from . import utils
 from .cuda_selector import CudaSelector
 RESOURCE_DEFAULT = 'void'
 RESOURCE_TYPES = (RESOURCE_DEFAULT, 'virtual', 'cpu', 'memory', 'gpu', 'vmem')
@@ -19,15 +22,30 @@ class AbstractResource:
         '''
         Attributes:
             self.book: tracking resource assignment
+            self.environ: environment variables for the requestors, e.g.
+                the assigned GPU. To be set in the environment of the task
+                process, since the daemon's own environment is shared.
+            self.affinity: CPU cores for the requestors, to pin the task
+                process to before it runs, so that all of its threads and
+                children inherit them.
         '''
         self.book = dict()
         self.acquire = dict()
         self.release = dict()
+        self.environ = dict()
+        self.affinity = dict()
     def idle(self):
         '''
         Wait for some time.
         '''
         time.sleep(2)
+    def refresh(self) -> None:
+        '''
+        Take a snapshot of the (expensive to query) resource status. Called
+        once per scheduling pass, so that all the placements made during the
+        pass are accounted against the same snapshot plus the book.
+        '''
+        return None
     def avail(self) -> float:
         '''
         Total amount of available specific <kind> of resource.
@@ -38,6 +56,20 @@ class AbstractResource:
         check whether <rsc> of resource can be allocated. does not block.
         '''
         raise NotImplementedError(f'can I allocate <{rsc}>?')
+    def reserve(self, key: int, rsc: float, backfilled: Iterable = ()) -> None:
+        '''
+        Hold resource for a blocked task needing <rsc> during a scheduling
+        pass, so that tasks considered after it (backfill) cannot delay it.
+        Undone with self.release[key]().
+
+        The blocked task starts once the running tasks make room, except
+        the <backfilled> ones (keys in the book), which may outlive them.
+        Hence backfilling may only use what the blocked task cannot use
+        anyway: the capacity minus <rsc> minus what is already backfilled.
+        By default the whole <rsc> is held, i.e. nothing is backfilled.
+        '''
+        self.book[key] = rsc
+        self.release[key] = lambda: self.book.pop(key)
     def waitfor(self, rsc: float) -> None:
         '''
         wait until <rsc> of resource can be allocated. does indeed block.
@@ -45,13 +77,36 @@ class AbstractResource:
         raise NotImplementedError(f'is there <{rsc}>?')
     def request(self, pid: int, rsc: float) -> (callable, callable):
         '''
-        generate callback functions for allocating the requested resource
+        generate callback functions for allocating the requested resource.
+        The placement is decided here, so that self.environ[pid] and
+        self.affinity[pid] are known before the task process is spawned. acquire() takes the pid of the
+        task process when the key is not the pid.
         '''
-        def acquire():
+        def acquire(pid: int = None):
             raise NotImplementedError('how to allocate resource?')
         def release():
             raise NotImplementedError('how to release resource?')
         return (acquire, release)
+    def cancel(self, key: int) -> None:
+        '''
+        Forget a request that has not been acquired (e.g. the task could
+        not be started).
+        '''
+        for d in (self.acquire, self.release, self.environ, self.affinity):
+            d.pop(key, None)
+    def placement(self, key: int) -> object:
+        '''
+        The allocation of <key> as a JSON-serializable object, to be kept in
+        the allocation ledger of the database.
+        '''
+        return self.book[key]
+    def adopt(self, key: int, pid: int, placement: object) -> None:
+        '''
+        Book again the allocation of a task that is still running, from the
+        ledger (see self.placement), e.g. after a restart of the daemon.
+        '''
+        self.book[key] = placement
+        self.release[key] = lambda: self.book.pop(key)
 
 class VoidResource(AbstractResource):
     '''
@@ -64,7 +119,7 @@ class VoidResource(AbstractResource):
     def waitfor(self, rsc: float) -> None:
         return None
     def request(self, pid: int, rsc: float) -> None:
-        self.acquire[pid] = lambda: self.book.__setitem__(pid, rsc)
+        self.acquire[pid] = lambda proc=None: self.book.__setitem__(pid, rsc)
         self.release[pid] = lambda: self.book.pop(pid)
 
 class VirtualResource(AbstractResource):
@@ -75,13 +130,20 @@ class VirtualResource(AbstractResource):
     def avail(self) -> float:
         return 1.0
     def canalloc(self, rsc: float) -> bool:
-        return (rsc <= self.avail() - sum(self.book.values()))
+        # (with some slack for rounding errors, e.g. 1.0 - 0.9 < 0.1)
+        return (rsc <= self.avail() - sum(self.book.values()) + 1e-9)
     def waitfor(self, rsc: float) -> None:
         while not self.canalloc(rsc):
             self.idle()
     def request(self, pid: int, rsc: float) -> None:
-        self.acquire[pid] = lambda: self.book.__setitem__(pid, rsc)
+        self.acquire[pid] = lambda proc=None: self.book.__setitem__(pid, rsc)
         self.release[pid] = lambda: self.book.pop(pid)
+    def reserve(self, key: int, rsc: float, backfilled: Iterable = ()) -> None:
+        free = self.avail() - sum(self.book.values())
+        room = self.avail() - rsc \
+                - sum(self.book[k] for k in backfilled if k in self.book)
+        self.book[key] = max(0., free - max(0., room))
+        self.release[key] = lambda: self.book.pop(key)
 
 
 class GpuResource(AbstractResource):
@@ -90,25 +152,35 @@ class GpuResource(AbstractResource):
     We only consider a card "available" when >=97% video memory is free.
     '''
     cusel = CudaSelector()
+    cards = None
+    def refresh(self) -> None:
+        self.cards = self.cusel.availCards()
+    def _cards(self) -> list:
+        # available cards, excluding those registered in self.book
+        cards = self.cards if self.cards is not None else self.cusel.availCards()
+        return [card for card in cards if card.index not in self.book.values()]
     def avail(self) -> float:
         # Number of available cards
-        return float(len(cusel.availCards()))
+        return float(len(self._cards()))
     def canalloc(self, rsc: float) -> bool:
-        # available cards
-        cards = self.cusel.availCards()
-        # excluding those registered in self.book
-        cards = [card for card in cards if card.index not in self.book.values()]
-        return len(cards) > 0
+        return len(self._cards()) > 0
     def request(self, pid: int, rsc: float) -> None:
         # currently only support allocating 1 card at a time.
         assert(int(rsc) == 1)
-        exclude = set(self.book.values())
-        selcard = random.choice(self.cusel.availCards())
-        def acquire():
-            os.putenv('CUDA_VISIBLE_DEVICES', str(selcard.index))
+        selcard = random.choice(self._cards())
+        self.environ[pid] = {'CUDA_VISIBLE_DEVICES': str(selcard.index)}
+        def acquire(proc: int = None):
             self.book[pid] = selcard.index
+        def release():
+            self.book.pop(pid)
+            self.environ.pop(pid, None)
+            self.affinity.pop(pid, None)
         self.acquire[pid] = acquire
-        self.release[pid] = lambda: self.book.pop(pid)
+        self.release[pid] = release
+    def reserve(self, key: int, rsc: float, backfilled: Iterable = ()) -> None:
+        # a blocked task means that no card is free. nothing to hold.
+        self.book[key] = None
+        self.release[key] = lambda: self.book.pop(key)
 
 class VmemResource(AbstractResource):
     '''
@@ -117,41 +189,326 @@ class VmemResource(AbstractResource):
     smartly jam various tasks on the GPUs as appropriate. Unlike
     coarse-grained GPU allocation such as Slurm(CUDA) which allocate each
     card as a whole to the requestors.
+
+    The book maps pid to (card index, reserved memory).
     '''
     cusel = CudaSelector()
+    cards = None
+    def refresh(self) -> None:
+        self.cards = self.cusel.getCards()
+    def _free(self) -> dict:
+        '''
+        Free memory of each card, taking reservations into account: a task
+        may not have allocated the memory it reserved yet.
+        '''
+        booked = dict()
+        for (index, rsc) in self.book.values():
+            booked[index] = booked.get(index, 0) + rsc
+        return {card.index: min(card.memory_free,
+                                card.memory_total - booked.get(card.index, 0))
+                for card in self._cards()}
+    def _cards(self) -> list:
+        return self.cards if self.cards is not None else self.cusel.getCards()
     def avail(self) -> float:
-        cards = self.cusel.getCards()
-        return float(sum(card.memory_free for card in cards))
+        return float(sum(self._free().values()))
     def canalloc(self, rsc: float) -> bool:
-        # First round: cards that have enough free memory
-        cards = self.cusel.getCards()
-        cards = [card for card in cards if card.memory_free >= rsc]
-        # Second round: remove cards that have been allocated in the book
-        cards = [card for card in cards if card.index not in self.book.values()]
-        return len(cards) > 0
+        return any(free >= rsc for free in self._free().values())
     def request(self, pid: int, rsc: float) -> None:
-        exclude = self.book.values()
-        device_index = self.cusel.selectCard(rsc, exclude=exclude)
-        def acquire():
-            os.putenv('CUDA_VISIBLE_DEVICES', str(device_index))
-            self.book[pid] = rsc
+        # best fit: the card with the least free memory that is enough, so
+        # that larger chunks are left for larger tasks.
+        free = self._free()
+        fits = [k for k in free.keys() if free[k] >= rsc]
+        device_index = min(fits, key=lambda k: free[k])
+        self.environ[pid] = {'CUDA_VISIBLE_DEVICES': str(device_index)}
+        def acquire(proc: int = None):
+            self.book[pid] = (device_index, rsc)
+        def release():
+            self.book.pop(pid)
+            self.environ.pop(pid, None)
+            self.affinity.pop(pid, None)
         self.acquire[pid] = acquire
-        self.release[pid] = lambda: self.book.pop(pid)
+        self.release[pid] = release
+    def reserve(self, key: int, rsc: float, backfilled: Iterable = ()) -> None:
+        # hold the whole card with the most free memory, which is where
+        # the blocked task will most likely fit first.
+        free = self._free()
+        card = max(self._cards(), key=lambda card: free[card.index])
+        self.book[key] = (card.index, card.memory_total)
+        self.release[key] = lambda: self.book.pop(key)
+    def adopt(self, key: int, pid: int, placement: object) -> None:
+        super(VmemResource, self).adopt(key, pid, tuple(placement))
 
 class CpuResource(AbstractResource):
-    def __init__(self):
+    '''
+    CPU cores. Book specific (logical) cores for the requestors, and pin the
+    task processes onto them, so that concurrent tasks do not thrash each
+    other's caches. <rsc> is the number of cores, rounded up.
+
+    The cores of a task are taken from a single NUMA node when possible
+    (the node that fits most tightly), and whole physical cores (all the SMT
+    siblings) are preferred. With exclusive_smt (TASQUE_CPU_EXCLUSIVE_SMT=1)
+    tasks never share a physical core at all.
+
+    The book maps pid to the list of booked cores.
+    '''
+    exclusive_smt = bool(int(os.getenv('TASQUE_CPU_EXCLUSIVE_SMT', '0')))
+    def __init__(self, cpus: list = None, sysfs: str = '/sys/devices/system/cpu'):
         super(CpuResource, self).__init__()
-        raise NotImplementedError()
+        if cpus is not None:
+            self.cpus = sorted(cpus)
+        elif hasattr(os, 'sched_getaffinity'):
+            self.cpus = sorted(os.sched_getaffinity(0))
+        else:
+            self.cpus = list(range(os.cpu_count()))
+        self.siblings, self.nodes = dict(), dict()
+        for cpu in self.cpus:
+            path = os.path.join(sysfs, f'cpu{cpu}')
+            try:
+                with open(os.path.join(path, 'topology', 'thread_siblings_list')) as f:
+                    siblings = utils.cpulist(f.read())
+            except OSError:
+                siblings = [cpu]
+            self.siblings[cpu] = tuple(x for x in siblings if x in self.cpus)
+            nodes = os.listdir(path) if os.path.isdir(path) else []
+            nodes = [int(x[4:]) for x in nodes if re.match(r'node\d+$', x)]
+            self.nodes[cpu] = nodes[0] if nodes else 0
+    def _free(self) -> list:
+        used = set(cpu for cpus in self.book.values() for cpu in cpus)
+        return [cpu for cpu in self.cpus if cpu not in used]
+    def _pick(self, rsc: float) -> list:
+        '''
+        Select the cores for a request. None if there are not enough.
+        '''
+        n = max(1, math.ceil(rsc))
+        free = set(self._free())
+        # whole physical cores first, and siblings next to each other
+        whole = lambda cpu: all(x in free for x in self.siblings[cpu])
+        if self.exclusive_smt:
+            free = set(cpu for cpu in free if whole(cpu))
+        bynode = dict()
+        for cpu in free:
+            bynode.setdefault(self.nodes[cpu], []).append(cpu)
+        fits = [node for (node, cpus) in bynode.items() if len(cpus) >= n]
+        if fits:
+            pool = bynode[min(fits, key=lambda node: len(bynode[node]))]
+        else:
+            pool = list(free)
+        pool.sort(key=lambda cpu: (not whole(cpu), self.siblings[cpu], cpu))
+        picked = []
+        for cpu in pool:
+            if len(picked) >= n:
+                break
+            if cpu in picked:
+                continue
+            picked.extend(self.siblings[cpu] if self.exclusive_smt else [cpu])
+        return sorted(picked) if len(picked) >= n else None
+    def avail(self) -> float:
+        return float(len(self._free()))
+    def canalloc(self, rsc: float) -> bool:
+        return self._pick(rsc) is not None
+    def waitfor(self, rsc: float) -> None:
+        while not self.canalloc(rsc):
+            self.idle()
+    def request(self, pid: int, rsc: float) -> None:
+        cpus = self._pick(rsc)
+        # pinned by the task process itself before it runs (see the daemon
+        # launch), as setting the affinity of a running process afterwards
+        # misses the threads it has already started
+        self.affinity[pid] = cpus
+        def acquire(proc: int = None):
+            self.book[pid] = cpus
+        def release():
+            self.book.pop(pid)
+            self.affinity.pop(pid, None)
+        self.acquire[pid] = acquire
+        self.release[pid] = release
+    def reserve(self, key: int, rsc: float, backfilled: Iterable = ()) -> None:
+        free = self._free()
+        room = len(self.cpus) - max(1, math.ceil(rsc)) \
+                - sum(len(self.book[k]) for k in backfilled if k in self.book)
+        self.book[key] = free[max(0, room):]
+        self.release[key] = lambda: self.book.pop(key)
 
 class MemoryResource(AbstractResource):
+    '''
+    Memory (MB). A task is admitted if its request fits into MemAvailable
+    (/proc/meminfo) minus the outstanding reservations, i.e. the memory that
+    running tasks reserved but do not use yet (MemAvailable already accounts
+    for what they use). Once a task has been running for <settle> seconds,
+    its reservation is shrunk to <margin> times the peak RSS of its process
+    tree, so that a task that reserved 30 GB but uses 2 GB gives the
+    difference back to the others.
+
+    The book maps pid to the (current) reservation. When the book is keyed
+    otherwise (e.g. by task id), self.pids maps the keys to the pids.
+    '''
+    meminfo: str = '/proc/meminfo'
+    settle: float = 60.0
+    margin: float = 1.2
     def __init__(self):
         super(MemoryResource, self).__init__()
-        raise NotImplementedError()
+        self.snapshot = None
+        self.since, self.rss, self.peak = dict(), dict(), dict()
+        self.pids = dict()
+    def _memavail(self) -> float:
+        with open(self.meminfo) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.
+        raise RuntimeError(f'MemAvailable not found in {self.meminfo}')
+    def _rss(self, pid: int) -> float:
+        '''
+        Total RSS (MB) of a process and its descendants.
+        '''
+        total = 0
+        for x in [pid] + utils.descendants(pid):
+            try:
+                with open(f'/proc/{x}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+                            break
+            except OSError:
+                pass
+        return total / 1024.
+    def reconcile(self) -> None:
+        '''
+        Update the RSS of the tasks, and shrink settled reservations.
+        '''
+        now = time.time()
+        for (pid, since) in self.since.items():
+            self.rss[pid] = self._rss(self.pids.get(pid, pid))
+            self.peak[pid] = max(self.peak.get(pid, 0.), self.rss[pid])
+            if now - since >= self.settle:
+                self.book[pid] = min(self.book[pid], self.margin * self.peak[pid])
+    def refresh(self) -> None:
+        self.snapshot = self._memavail()
+        self.reconcile()
+    def _free(self) -> float:
+        avail = self.snapshot if self.snapshot is not None else self._memavail()
+        outstanding = sum(max(0., rsc - self.rss.get(pid, 0.))
+                          for (pid, rsc) in self.book.items())
+        return avail - outstanding
+    def avail(self) -> float:
+        return self._free()
+    def canalloc(self, rsc: float) -> bool:
+        return rsc <= self._free()
+    def waitfor(self, rsc: float) -> None:
+        while not self.canalloc(rsc):
+            self.snapshot = None
+            self.idle()
+    def request(self, pid: int, rsc: float) -> None:
+        def acquire(proc: int = None):
+            self.book[pid] = rsc
+            self.since[pid] = time.time()
+            self.rss[pid] = 0.
+            if proc is not None:
+                self.pids[pid] = proc
+        def release():
+            for d in (self.book, self.since, self.rss, self.peak, self.pids):
+                d.pop(pid, None)
+        self.acquire[pid] = acquire
+        self.release[pid] = release
+    def adopt(self, key: int, pid: int, placement: object) -> None:
+        # the reservation settles again from now on
+        self.request(key, placement)
+        self.acquire[key](pid)
+    def reserve(self, key: int, rsc: float, backfilled: Iterable = ()) -> None:
+        # the running tasks give back what they reserved and what they use
+        free = self._free()
+        capacity = (self.snapshot if self.snapshot is not None else self._memavail()) \
+                + sum(self.rss.values())
+        room = capacity - rsc \
+                - sum(self.book[k] for k in backfilled if k in self.book)
+        self.book[key] = max(0., free - max(0., room))
+        self.release[key] = lambda: self.book.pop(key)
+
+class CompositeResource(AbstractResource):
+    '''
+    Several kinds of resource managed at once, e.g. 'cpu,memory,vmem'.
+    A task requests a vector such as {'cpu': 2, 'memory': 8192, 'vmem': 6000}
+    and is only admitted when every dimension fits, so that mixed workloads
+    can share the node without oversubscribing any of them. Each dimension
+    places its part with its own best-fit policy (e.g. the GPU card).
+    A scalar request is interpreted by the first kind.
+
+    The book maps pid to the requested vector.
+    '''
+    def __init__(self, names: list):
+        super(CompositeResource, self).__init__()
+        self.kinds = {name: create(name) for name in names}
+    def vector(self, rsc: object) -> dict:
+        if isinstance(rsc, dict):
+            return rsc
+        return {next(iter(self.kinds)): rsc}
+    def refresh(self) -> None:
+        for kind in self.kinds.values():
+            kind.refresh()
+    def avail(self) -> dict:
+        return {name: kind.avail() for (name, kind) in self.kinds.items()}
+    def canalloc(self, rsc: object) -> bool:
+        vec = self.vector(rsc)
+        if any(name not in self.kinds for name in vec.keys()):
+            return False
+        return all(self.kinds[name].canalloc(v) for (name, v) in vec.items())
+    def waitfor(self, rsc: object) -> None:
+        while not self.canalloc(rsc):
+            self.idle()
+    def _each(self, pid: int, vec: dict, method: str, **kwargs) -> None:
+        environ = dict()
+        for (name, v) in vec.items():
+            getattr(self.kinds[name], method)(pid, v, **kwargs)
+            environ.update(self.kinds[name].environ.get(pid, {}))
+            if pid in self.kinds[name].affinity:
+                self.affinity[pid] = self.kinds[name].affinity[pid]
+        if environ:
+            self.environ[pid] = environ
+        def acquire(proc: int = None):
+            for name in vec.keys():
+                self.kinds[name].acquire[pid](proc)
+            self.book[pid] = vec
+        def release():
+            for name in vec.keys():
+                self.kinds[name].release[pid]()
+            self.book.pop(pid)
+            self.environ.pop(pid, None)
+            self.affinity.pop(pid, None)
+        self.acquire[pid] = acquire
+        self.release[pid] = release
+    def request(self, pid: int, rsc: object) -> None:
+        self._each(pid, self.vector(rsc), 'request')
+    def cancel(self, key: int) -> None:
+        for kind in self.kinds.values():
+            kind.cancel(key)
+        super(CompositeResource, self).cancel(key)
+    def placement(self, key: int) -> object:
+        return {name: [v, self.kinds[name].placement(key)]
+                for (name, v) in self.book[key].items()}
+    def adopt(self, key: int, pid: int, placement: object) -> None:
+        vec = dict()
+        for (name, (v, where)) in placement.items():
+            if name in self.kinds:
+                self.kinds[name].adopt(key, pid, where)
+                vec[name] = v
+        self.book[key] = vec
+        def release():
+            for name in vec.keys():
+                self.kinds[name].release[key]()
+            self.book.pop(key)
+        self.release[key] = release
+    def reserve(self, key: int, rsc: object, backfilled: Iterable = ()) -> None:
+        vec = {name: v for (name, v) in self.vector(rsc).items()
+               if name in self.kinds}
+        self._each(key, vec, 'reserve', backfilled=list(backfilled))
+        self.book[key] = vec
 
 def create(name: str):
     '''
-    factory function
+    factory function. A comma-separated list of names creates a
+    CompositeResource.
     '''
+    if ',' in name:
+        return CompositeResource([x.strip() for x in name.split(',') if x.strip()])
     mapping = {
             RESOURCE_DEFAULT: VoidResource,
             'virtual': VirtualResource,
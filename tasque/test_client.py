@@ -0,0 +1,77 @@
+'''
+Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
+License: MIT/Expat
+'''
+
+import os
+import json
+import pytest
+import zstd
+from tasque import defs
+from tasque.client import *
+
+def test_tail(tmp_path, monkeypatch, capfdbinary):
+    monkeypatch.setattr(defs, 'TASQUE_DB', os.path.join(tmp_path, 'test.db'))
+    monkeypatch.setattr(defs, 'TASQUE_DIR', str(tmp_path))
+    client = tqClient()
+    taskid = client.enqueue(cwd='/', cmd='true')
+    client.db('UPDATE tq SET state = ? WHERE (id = ?)', ('done', taskid))
+    lines = [f'line {i}\n'.encode() for i in range(100)]
+    path = os.path.join(tmp_path, f'tq_id-{taskid}_20210101.000000.stdout.zst')
+    with open(path, 'wb') as f:
+        for i in range(0, 100, 7):
+            f.write(zstd.compress(b''.join(lines[i:i+7])))
+        # a frame that is still being written
+        f.write(zstd.compress(b'incomplete\n')[:-3])
+    capfdbinary.readouterr()
+    client.tail(taskid, lines=3)
+    assert(capfdbinary.readouterr().out == b''.join(lines[-3:]))
+    client.tail(taskid, lines=1000, follow=True)
+    assert(capfdbinary.readouterr().out == b''.join(lines))
+
+def test_estimate(tmp_path, monkeypatch):
+    monkeypatch.setattr(defs, 'TASQUE_DB', os.path.join(tmp_path, 'test.db'))
+    client = tqClient()
+    client.config('resource', 'memory, cpu')
+    client.db('insert into history values (?, ?, ?, ?, ?, ?)',
+              ('/', 'python train.py --seed #', 3, 1000, None, 1.5))
+    assert(client.estimate('/', 'python  train.py --seed 42') ==
+           {'memory': 1200, 'cpu': 2})
+    assert(client.estimate('/tmp', 'python train.py --seed 42') == {})
+    taskid = client.enqueue(cwd='/', cmd='python train.py --seed 7',
+                            rscv={'cpu': 4}, auto_rsc=True)
+    rscv, = client.db['select rscv from tq where (id = ?)', (taskid,)][0]
+    assert(json.loads(rscv) == {'memory': 1200, 'cpu': 4})
+    # with a single kind, an explicit scalar request takes precedence too
+    client.config('resource', 'memory')
+    for rsc in (None, 500):
+        taskid = client.enqueue(cwd='/', cmd='python train.py --seed 7',
+                                rsc=rsc, auto_rsc=True)
+        assert(client.db['select rsc from tq where (id = ?)', (taskid,)] ==
+               [(rsc or 1200,)])
+
+def test_enqueue_retry(tmp_path, monkeypatch):
+    monkeypatch.setattr(defs, 'TASQUE_DB', os.path.join(tmp_path, 'test.db'))
+    client = tqClient()
+    for retry in (defs.Retry(None, 3, None, '3,oom', None),
+                  defs.Retry(None, 3, None, None, '(')):
+        with pytest.raises(ValueError):
+            client.enqueue(cwd='/', cmd='true', retry=retry)
+    assert(client.db['tq'] == [])
+    client.enqueue(cwd='/', cmd='true', retry=defs.Retry(None, 3, None, '1, -9', 'oom'))
+    assert(len(client.db['retry']) == 1)
+
+def test_enqueue_rscv(tmp_path, monkeypatch):
+    monkeypatch.setattr(defs, 'TASQUE_DB', os.path.join(tmp_path, 'test.db'))
+    client = tqClient()
+    client.config('resource', 'cpu,memory')
+    # kinds the daemon does not manage, or several GPU cards
+    for rscv in ({'gpu': 1}, {'cpu': 1, 'vmem': 2000}):
+        with pytest.raises(ValueError):
+            client.enqueue(cwd='/', cmd='true', rscv=rscv)
+    client.config('resource', 'gpu')
+    with pytest.raises(ValueError):
+        client.enqueue(cwd='/', cmd='true', rscv={'gpu': 2})
+    assert(client.db['tq'] == [])
+    client.enqueue(cwd='/', cmd='true', rscv={'gpu': 1})
+    assert(len(client.db['tq']) == 1)
@@ -0,0 +1,528 @@
+'''
+Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
+License: MIT/Expat
+'''
+
+import glob
+import os
+import pytest
+import logging
+import signal
+import sqlite3
+import threading
+import time
+import zstd
+from tasque.db import *
+from tasque.defs import *
+from tasque.daemon import *
+from tasque import wrapper
+from tasque.resources import CpuResource
+
+def test_writer(tmp_path):
+    path = os.path.join(tmp_path, 'test.db')
+    tq = tqDB(path)
+    t = Task(None, None, '/', 'true', None, None, None, 0, 1.0, 'pending')
+    ids = tq.insert_tasks([t, t])
+    writer = tqWriter(path, logging, interval=0.01)
+    writer.start()
+    writer.inflight.update(ids)
+    writer.put(('started', ids[0], 123, 1.0))
+    writer.put(('started', ids[1], 124, 1.0))
+    writer.put(('finished', ids[0], 0, 2.0))
+    writer.put(('finished', ids[1], 1, 2.0))
+    writer.close()
+    assert(tq['select state, retval, stime, etime from tq order by id'] ==
+           [('done', 0, 1.0, 2.0), ('failed', 1, 1.0, 2.0)])
+    assert(len(writer.inflight) == 0)
+    # events arriving out of order do not resurrect a finished task
+    ids = tq.insert_tasks([t])
+    writer = tqWriter(path, logging, interval=0.01)
+    writer.start()
+    writer.put(('finished', ids[0], 0, 2.0))
+    writer.put(('started', ids[0], 125, 1.0))
+    writer.close()
+    assert(tq['select state, pid from tq where (id = ?)', (ids[0],)] == [('done', None)])
+    # a batch that fails to commit is retried, not dropped
+    ids = tq.insert_tasks([t])
+    writer = tqWriter(path, logging, interval=0.01)
+    commit, failures = writer.commit, []
+    def flaky(db_, events):
+        if not failures:
+            failures.append(events)
+            raise sqlite3.OperationalError('database is locked')
+        commit(db_, events)
+    writer.commit = flaky
+    writer.start()
+    writer.inflight.add(ids[0])
+    writer.put(('started', ids[0], 126, 1.0))
+    writer.put(('finished', ids[0], 0, 2.0))
+    writer.close()
+    assert(len(failures) == 1)
+    assert(tq['select state, pid from tq where (id = ?)', (ids[0],)] == [('done', None)])
+    assert(len(writer.inflight) == 0)
+
+def _daemon(tmp_path, monkeypatch, tasks, config={}):
+    monkeypatch.setattr(defs, 'TASQUE_DB', os.path.join(tmp_path, 'test.db'))
+    monkeypatch.setattr(defs, 'TASQUE_LOG', os.path.join(tmp_path, 'test.log'))
+    monkeypatch.setattr(defs, 'TASQUE_DIR', str(tmp_path))
+    monkeypatch.setattr(defs, 'TASQUE_SOCK', os.path.join(tmp_path, 'tasque.sock'))
+    tq = tqDB(defs.TASQUE_DB)
+    tq.executemany('INSERT INTO config (key, value) VALUES (?, ?)',
+                   list(config.items()))
+    tq('UPDATE config SET value = ? WHERE (key = ?)', ('virtual', 'resource'))
+    tq.insert_tasks(Task(None, None, '/', 'true', None, None, None, pri, rsc,
+                         'pending') for (pri, rsc) in tasks)
+    d = tqD()
+    d.launched = []
+    def launch(task):
+        d.launched.append(task.id)
+        d.writer.inflight.add(task.id)
+        d.resource.request(task.id, task.rsc)
+        d.resource.acquire[task.id]()
+    d.launch = launch
+    return d
+
+@pytest.fixture
+def running():
+    '''
+    Start daemons for a test (listening, with the writer thread), and stop
+    them whatever the outcome of the test.
+    '''
+    daemons = []
+    def start(d, listen: bool = True):
+        daemons.append(d)
+        if listen:
+            d.listen()
+        d.writer.start()
+        return d
+    yield start
+    for d in daemons:
+        for pid in d.workerpool:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for server in d.forkservers:
+            server.close(wait=False)
+        if d.writer.is_alive():
+            d.writer.close()
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+def _loop(cond, timeout: float = 30.0):
+    '''
+    Iterate while cond() holds, failing the test after <timeout> seconds
+    instead of hanging.
+    '''
+    deadline = time.time() + timeout
+    while cond():
+        assert time.time() < deadline, f'still waiting after {timeout}s'
+        yield
+
+def test_schedule_fifo(tmp_path, monkeypatch):
+    d = _daemon(tmp_path, monkeypatch, [(0, 0.1)] * 10 + [(0, 0.5)])
+    assert(d.schedule() == (10, 1))
+    assert(d.launched == list(range(1, 11)))
+
+def test_schedule_backfill(tmp_path, monkeypatch):
+    tasks = [(1, 0.6), (1, 0.5), (0, 0.4), (0, 0.2)]
+    d = _daemon(tmp_path, monkeypatch, tasks)
+    assert(d.schedule() == (1, 1))
+    assert(d.launched == [1])
+    d = _daemon(tmp_path / 'b', monkeypatch, tasks + [(0, 0.1)],
+                {'scheduler': 'backfill'})
+    # task 2 is blocked, task 3 fits into what task 2 cannot use anyway
+    assert(d.schedule() == (2, 3))
+    assert(d.launched == [1, 3])
+    # task 3 may outlive task 1: nothing more, or task 2 would be delayed
+    assert(d.schedule() == (0, 3))
+    d.resource.release[1]()
+    assert(d.schedule() == (2, 1))
+    assert(d.launched == [1, 3, 2, 5])
+
+def test_schedule_sync(tmp_path, monkeypatch):
+    d = _daemon(tmp_path, monkeypatch, [(0, 0.5)] * 3)
+    assert(d.schedule() == (2, 1))
+    # new submissions are picked up incrementally
+    d.db.insert_tasks([Task(None, None, '/', 'true', None, None, None, 1, 0.5, 'pending')])
+    d.resource.release[1]()
+    assert(d.schedule() == (1, 1))
+    assert(d.launched == [1, 2, 4])
+    # changes to existing tasks are noticed at launch
+    d.db('UPDATE tq SET rsc = ? WHERE (id = ?)', (0.1, 3))
+    d.resource.release[2]()
+    assert(d.schedule() == (0, 0))
+    assert(d.stale)
+    assert(d.schedule() == (1, 0))
+    assert(d.launched == [1, 2, 4, 3])
+    # a rescan while launched tasks are not yet committed as running
+    d = _daemon(tmp_path / 'b', monkeypatch, [(0, 0.8), (1, 0.3)])
+    assert(d.schedule() == (1, 1))
+    d.stale = True
+    assert(d.schedule() == (0, 1))
+    assert(d.schedule() == (0, 1))
+    assert(d.launched == [2])
+
+def test_setting(tmp_path, monkeypatch):
+    config = {'archive_after': '1d', 'scan_depth': '8.5', 'python_pool': '2',
+              'flush_interval': 'fast'}
+    d = _daemon(tmp_path, monkeypatch, [(0, 0.5)] * 3, config)
+    # invalid values fall back to the defaults instead of raising
+    assert(d.writer.interval == tqWriter.interval)
+    assert(d.setting('scan_depth', d.scan_depth) == d.scan_depth)
+    assert(d.setting('python_pool', 1) == 2)
+    d.autoarchive()
+    assert(d.schedule() == (2, 1))
+    assert(len(d.invalid) == 3)
+
+def test_launch(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, []))
+    for cmd in ('sh -c "echo hello; exit 3"', 'true', 'nonexistent-command'):
+        d.db.insert_tasks([Task(None, None, str(tmp_path), cmd, None, None,
+                                None, 0, 0.1, 'pending')])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    assert(d.schedule() == (3, 0))
+    for _ in _loop(lambda: d.workerpool):
+        d.idle()
+        d.reap()
+    assert(len(d.resource.book) == 0)
+    d.writer.close()
+    # (a command that cannot be run fails like in a shell)
+    assert(d.db['select state, retval from tq order by id'] ==
+           [('failed', 3), ('done', 0), ('failed', 127)])
+    assert([x.id for x in d.db['usage']] == [1, 2, 3])
+    # the spools and the status files are gone
+    assert(glob.glob(os.path.join(tmp_path, 'tq_id-*.spool')) == [] and
+           glob.glob(os.path.join(tmp_path, 'tq_id-*.status')) == [])
+    # only successful tasks make history
+    assert([(x.cmd, x.runs) for x in d.db['history']] == [('true', 1)])
+
+def test_launch_unplaceable(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, []))
+    d.db.insert_tasks([Task(None, None, str(tmp_path), 'true', None, None,
+                            None, 0, rsc, 'pending') for rsc in (0.2, 0.1)])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    request = d.resource.request
+    def refuse(key, rsc):
+        assert(rsc != 0.2)
+        request(key, rsc)
+    d.resource.request = refuse
+    # the resource cannot place task 1: only that task fails
+    assert(d.schedule() == (2, 0))
+    for _ in _loop(lambda: d.workerpool):
+        d.idle()
+        d.reap()
+    d.writer.close()
+    assert(d.db['select state, retval from tq order by id'] ==
+           [('failed', -1), ('done', 0)])
+    assert(len(d.resource.book) == 0)
+
+def test_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(defs, 'TASQUE_DIR', str(tmp_path))
+    spool = os.path.join(tmp_path, 'tq_id-7.spool')
+    w = os.open(spool, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    task = Task(7, None, '/', 'true', None, None, None, 0, 1.0, 'running')
+    done = threading.Event()
+    t = threading.Thread(target=tasqueOutput, args=(open(spool, 'rb'), logging,
+                         task), kwargs=dict(chunk=8, interval=0.05, done=done,
+                         poll=0.01, linger=0.5))
+    t.start()
+    os.write(w, b'hello')
+    time.sleep(0.3)
+    # partial output is on disk before the task finishes
+    path, = glob.glob(os.path.join(tmp_path, '*.stdout.zst'))
+    with open(path, 'rb') as f:
+        assert(zstd.decompress(f.read()) == b'hello')
+    os.write(w, b' world' * 4)
+    # the task exited: what its leftovers write shortly after is kept too
+    done.set()
+    os.write(w, b'!')
+    os.close(w)
+    t.join()
+    with open(path, 'rb') as f:
+        assert(zstd.decompress(f.read()) == b'hello' + b' world' * 4 + b'!')
+    # what is collected is known from the output file
+    assert(tasqueDrained(path) == 30)
+
+def test_sample(tmp_path, monkeypatch, running):
+    class FakeCudaSelector:
+        def getApps(self):
+            return [(pid, 100) for pid in d.workerpool]
+    d = _daemon(tmp_path, monkeypatch, [])
+    d.cusel = FakeCudaSelector()
+    # typos in the config (reloaded live) are not fatal
+    d.config.update(sample_bucket='10m', sample_retention='2w')
+    running(d, listen=False)
+    d.db.insert_tasks([Task(None, None, '/', 'sleep 10', None, None, None, 0,
+                            0.1, 'pending')])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    assert(d.schedule() == (1, 0))
+    d.sample()
+    d.last_sample = 0.0
+    d.sample()
+    for pid, (_, proc, _) in d.workerpool.items():
+        proc.kill()
+    d.reap(block=True)
+    d.writer.close()
+    samples = d.db['samples']
+    assert(len(samples) == 2)
+    assert(samples[0].cpu is None and samples[1].cpu is not None)
+    assert(all(x.rss > 0 and x.vmem == 100 for x in samples))
+
+def test_forkserver(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, [], {'python_preload': 'json'}))
+    with open(os.path.join(tmp_path, 'x.json'), 'w') as f:
+        f.write('{}')
+    for argv in ('json.tool x.json', 'json.tool --nonexistent-option'):
+        d.db.insert_tasks([Task(None, None, str(tmp_path), argv, None, None,
+                                None, 0, 0.1, 'pending', None, 'json.tool:main')])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    # the tasks wait for the template to import the modules
+    assert(d.schedule() == (0, 0))
+    server, = d.forkservers
+    for _ in _loop(lambda: not server.ready):
+        d.idle(busy=False)
+    assert(d.schedule() == (2, 0))
+    # the tasks are forked from the template
+    for pid in d.workerpool:
+        with open(f'/proc/{pid}/stat') as f:
+            assert(int(f.read().rsplit(')', 1)[1].split()[1]) == server.proc.pid)
+    for _ in _loop(lambda: d.workerpool):
+        d.idle()
+        d.reap()
+    server.close()
+    d.writer.close()
+    assert(d.db['select state, retval from tq order by id'] ==
+           [('done', 0), ('failed', 2)])
+
+def test_launch_env(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, []))
+    cmd = 'sh -c \'test "$FOO" = bar && test -z "$BAR"\''
+    task = Task(None, None, str(tmp_path), cmd, None, None, None, 0, 0.1, 'pending')
+    # the recorded environment of the submitter replaces the daemon's
+    monkeypatch.setenv('BAR', 'daemon')
+    d.db.insert_tasks([task, task], [{'FOO': 'bar', 'PATH': os.environ['PATH']}, None])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    assert(d.schedule() == (2, 0))
+    for _ in _loop(lambda: d.workerpool):
+        d.idle()
+        d.reap()
+    d.writer.close()
+    assert(d.db['select state from tq order by id'] == [('done',), ('failed',)])
+
+def test_launch_affinity(tmp_path, monkeypatch, running):
+    d = _daemon(tmp_path, monkeypatch, [])
+    cpu = max(os.sched_getaffinity(0))
+    d.resource = CpuResource(cpus=[cpu])
+    running(d)
+    # the command is pinned from the start, not after it was spawned
+    cmd = f'grep -qx "Cpus_allowed_list:[[:space:]]*{cpu}" /proc/self/status'
+    d.db.insert_tasks([Task(None, None, str(tmp_path), cmd, None, None, None,
+                            0, 1, 'pending')])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    assert(d.schedule() == (1, 0))
+    for _ in _loop(lambda: d.workerpool):
+        d.idle()
+        d.reap()
+    d.writer.close()
+    assert(d.db['select state from tq'] == [('done',)])
+
+def test_recover(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, []))
+    cmds = ('sleep 30', 'sh -c "head -c 3000000 /dev/zero; echo; exit 3"', 'sleep 30')
+    d.db.insert_tasks([Task(None, None, str(tmp_path), cmd, None, None, None,
+                            0, 0.3, 'pending') for cmd in cmds])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    # the daemon goes away right after the launch: nobody reads the output
+    pids = dict()
+    def watch(task, pid, proc, pidfd, spool, output):
+        pids[task.id] = pid
+        spool.close()
+    d.watch = watch
+    assert(d.schedule() == (3, 0))
+    d.writer.close()
+    alloc = d.db['alloc'][0]
+    assert(alloc.pid == pids[1] and alloc.pstart == utils.procstart(pids[1]))
+    # the chatty task is not held up (we stand in for init, reaping it)
+    for _ in _loop(lambda: os.waitpid(pids[2], os.WNOHANG)[0] == 0, 10):
+        time.sleep(0.05)
+    # and this one is gone without telling its status
+    os.kill(pids[3], signal.SIGKILL)
+    os.waitpid(pids[3], 0)
+    e = running(tqD(), listen=False)
+    e.recover()
+    assert(sorted(e.workerpool) == [pids[1], pids[2]])
+    task, proc, _ = e.workerpool[pids[1]]
+    assert(isinstance(proc, tqAdopted) and task.id == 1)
+    assert(e.resource.book == {1: 0.3, 2: 0.3})
+    threads = [thread for (thread, _, _) in e.outputs.values()]
+    # task 2 exited in between
+    assert(e.reap() == 1)
+    os.kill(pids[1], signal.SIGTERM)
+    os.waitpid(pids[1], 0)
+    e.reap(block=True)
+    for thread in threads:
+        thread.join()
+    e.writer.close()
+    # the adopted tasks end with their own exit status
+    assert(d.db['select state, retval from tq order by id'] ==
+           [('failed', -15), ('failed', 3), ('accident', None)])
+    assert(d.db['alloc'] == [] and d.db['select id from usage'] == [(1,), (2,)])
+    path, = glob.glob(os.path.join(tmp_path, 'tq_id-2_*.stdout.zst'))
+    with open(path, 'rb') as f:
+        assert(zstd.decompress(f.read()) == b'\0' * 3000000 + b'\n')
+    assert(glob.glob(os.path.join(tmp_path, 'tq_id-*.spool')) == [] and
+           glob.glob(os.path.join(tmp_path, 'tq_id-*.status')) == [])
+
+def test_retry(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, [], {'retry_backoff': '0.1'}))
+    cmds = ('sh -c "echo boom; exit 3"', 'sh -c "echo boom; exit 3"',
+            'sh -c "test -e x || { touch x; echo boom; exit 1; }"',
+            'sh -c "exit 4"')
+    retries = (Retry(None, 3, None, None, None), Retry(None, 3, None, None, 'bang'),
+               Retry(None, 3, None, None, 'bo+m'), Retry(None, 3, None, '1,2', None))
+    d.db.insert_tasks([Task(None, None, str(tmp_path), cmd, None, None, None,
+                            0, 0.1, 'pending') for cmd in cmds], None, retries)
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    for _ in _loop(lambda: d.schedule()[0] or d.workerpool or d.retrying
+                   or d.holds):
+        d.idle(busy=False)
+        d.reap()
+    d.writer.close()
+    assert(d.db['select state, retval from tq order by id'] ==
+           [('failed', 3), ('failed', 3), ('done', 0), ('failed', 4)])
+    attempts = d.db['select id, attempt, retval from attempts order by id, attempt']
+    assert(attempts == [(1, 1, 3), (1, 2, 3), (1, 3, 3), (2, 1, 3),
+                        (3, 1, 1), (3, 2, 0), (4, 1, 4)])
+    # with the backoff doubling in between
+    etime = {(x.id, x.attempt): x.etime for x in d.db['attempts']}
+    stime = {(x.id, x.attempt): x.stime for x in d.db['attempts']}
+    assert(stime[1, 3] - etime[1, 2] >= 0.2 and stime[1, 2] - etime[1, 1] >= 0.1)
+
+def test_retry_blocked(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, [(0, 0.8), (0, 0.5)]))
+    assert(d.schedule() == (1, 1))
+    # the backoff of task 2 is over, but it is blocked on resources
+    d.holds[2] = time.time() - 1
+    begin, passes = time.time(), 0
+    while time.time() - begin < 1.0:
+        assert(d.schedule() == (0, 1))
+        d.idle(busy=True)
+        passes += 1
+    # the expired hold is gone, and the daemon backs off instead of spinning
+    assert(2 not in d.holds)
+    assert(passes <= 3)
+
+def test_memo(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, []))
+    d.launch = lambda task: tqD.launch(d, task)
+    (tmp_path / 'in.txt').write_text('hello\n')
+    def run(seed, inputs='["*.txt"]'):
+        task = Task(None, None, str(tmp_path), 'sh -c "cat in.txt; echo >> log"',
+                    None, None, None, 0, 0.1, 'pending')
+        env = {'PATH': os.environ['PATH'], 'SEED': seed}
+        taskid, = d.db.insert_tasks([task], [env], None,
+                [Memo(None, inputs, '["SEED"]', None)])
+        d.sync()
+        # the memo key is computed off the loop, the task waits for it
+        for _ in _loop(lambda: d.db['select state from tq where (id = ?)',
+                                    (taskid,)][0][0] not in ('done', 'failed')):
+            d.schedule()
+            d.idle()
+            d.reap()
+        for _ in _loop(lambda: d.writer.inflight):
+            time.sleep(0.05)
+        return taskid
+    run('1')
+    # same inputs: completed from the cache, with the same output
+    taskid = run('1')
+    assert((tmp_path / 'log').read_text() == '\n')
+    assert(d.db['select state from tq where (id = ?)', (taskid,)] == [('done',)])
+    path, = glob.glob(os.path.join(tmp_path, f'tq_id-{taskid}_*.stdout.zst'))
+    with open(path, 'rb') as f:
+        assert(zstd.decompress(f.read()) == b'hello\n')
+    # the inputs or the environment changed
+    (tmp_path / 'in.txt').write_text('world\n')
+    run('1')
+    run('2')
+    # a key that cannot be computed: the task simply runs
+    run('2', inputs='{')
+    d.writer.close()
+    assert((tmp_path / 'log').read_text() == '\n' * 4)
+    assert(len(d.db['cache']) == 3)
+    digest, = [x.digest for x in d.db['hashes']]
+    assert(digest == utils.filehash(os.path.join(tmp_path, 'in.txt')))
+
+def test_forkserver_malformed(tmp_path):
+    server = forkserver.tqForkServer([])
+    assert(server._recv()['event'] == 'ready' and server.ready)
+    # requests without the stdout fd, or garbled, are refused
+    for msg in (b'{"entry": "json.tool:main"}', b'{'):
+        server.sock.send(msg)
+        assert(server._recv()['event'] == 'error')
+    # and the template is still serving
+    r, w = os.pipe()
+    pid = server.spawn('json.tool:main', ['--help'], str(tmp_path), w)
+    os.close(w)
+    assert(server.wait4(pid)[1] == 0)
+    with open(r, 'rb') as f:
+        assert(b'usage' in f.read())
+    server.close()
+    # a template that does not answer is given up on
+    server = forkserver.tqForkServer([])
+    os.kill(server.proc.pid, signal.SIGSTOP)
+    begin = time.time()
+    with pytest.raises(OSError):
+        server.spawn('json.tool:main', [], str(tmp_path), 1, timeout=0.5)
+    assert(time.time() - begin < 5 and not server.alive())
+    server.close()
+
+def test_forkserver_orphaned(tmp_path):
+    (tmp_path / 'slow.py').write_text('import time\n'
+            'def main():\n    time.sleep(0.5)\n    return 3\n')
+    server = forkserver.tqForkServer([])
+    status = os.path.join(tmp_path, 'status')
+    r, w = os.pipe()
+    server.spawn('slow:main', [], str(tmp_path), w, status=status)
+    os.close(w)
+    # the daemon goes away: the template stays to record the exit status
+    server.close(wait=False)
+    assert(server.proc.wait(timeout=10) == 0)
+    code, ru = wrapper.readstatus(status)
+    assert(os.waitstatus_to_exitcode(code) == 3 and ru.ru_maxrss > 0)
+    os.close(r)
+
+def test_retry_deferred(tmp_path, monkeypatch, running):
+    d = running(_daemon(tmp_path, monkeypatch, [], {'retry_backoff': '0.1'}))
+    # the output is held open by a grandchild after the task exits
+    cmd = 'sh -c "echo boom; sleep 1 & exit 3"'
+    d.db.insert_tasks([Task(None, None, str(tmp_path), cmd, None, None, None,
+                            0, 0.1, 'pending')] * 2, None,
+                      [Retry(None, 2, None, None, 'boom'),
+                       Retry(None, 2, None, 'oops', '(')])
+    d.sync(full=True)
+    d.launch = lambda task: tqD.launch(d, task)
+    assert(d.schedule() == (2, 0))
+    for _ in _loop(lambda: d.workerpool):
+        d.idle()
+        begin = time.time()
+        d.reap()
+        # the loop does not wait for the output
+        assert(time.time() - begin < 0.5)
+    assert(list(d.exited) == [1])
+    for _ in _loop(lambda: d.schedule()[0] or d.workerpool or d.exited
+                   or d.retrying or d.holds):
+        d.idle(busy=False)
+        d.reap()
+    d.writer.close()
+    # a bad policy means no retry
+    assert(d.db['select id, attempt from attempts order by id, attempt'] ==
+           [(1, 1), (1, 2), (2, 1)])
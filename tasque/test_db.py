@@ -9,13 +9,15 @@ install()
 c = rich.get_console()
 import pytest
 import os
+import sqlite3
 from tasque.db import *
 from tasque.defs import *
+from tasque import utils
 
 def test_db(tmp_path):
     tq = tqDB(os.path.join(tmp_path, 'test.db'))
 
-    t = Task._make(['1', '1', 'test', 'test', '0', '0', '0', '0', '0'])
+    t = Task._make(['1', '1', 'test', 'test', '0', '0', '0', '0', '0', 'done', None, None])
     tq += t
     c.print(tq['tq'])
     assert(len(tq['tq']) == 1)
@@ -27,5 +29,104 @@ def test_db(tmp_path):
 
     del tq
 
+def test_db_connection(tmp_path):
+    tq = tqDB(os.path.join(tmp_path, 'test.db'))
+    assert(tq['PRAGMA journal_mode'][0][0] == 'wal')
+    conn = tq.conn
+    tq('CREATE TABLE foo (bar)')
+    assert(tq.conn is conn)
+    # the connection must be reopened in a forked child
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            ok = tq.conn is not conn and len(tq['select * from foo']) == 0
+        finally:
+            os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert(os.WEXITSTATUS(status) == 0)
+    tq.close()
+
+def test_db_bulk(tmp_path):
+    tq = tqDB(os.path.join(tmp_path, 'test.db'))
+    tasks = [Task(i, None, '/', f'echo {i}', None, None, None, 0, 1.0, 'pending')
+             for i in range(1, 10001)]
+    tq.insert_tasks(tasks)
+    assert(len(tq['tq']) == 10000)
+    R = tq['select cmd from tq where (id = ?)', (42,)]
+    assert(R == [('echo 42',)])
+    # streaming
+    it = tq.iter('select id from tq order by id', batch=7)
+    assert(next(it) == (1,))
+    assert(sum(1 for _ in it) == 9999)
+    assert(next(tq.iter('tq')).cmd == 'echo 1')
+    tq.executemany('update tq set pri = ? where (id = ?)',
+                   [(1, i) for i in range(1, 101)])
+    assert(tq['select count(*) from tq where (pri = ?)', (1,)][0][0] == 100)
+
+def test_db_migrate(tmp_path):
+    # an unversioned database, as created by older releases
+    path = os.path.join(tmp_path, 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE config (key, value)')
+    conn.execute('CREATE TABLE tq (id, pid, cwd, cmd, retval, stime, etime, pri, rsc)')
+    conn.execute('CREATE TABLE notes (noteid, id, note)')
+    conn.executemany('INSERT INTO tq VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+        (1, 'null', '/', 'true', 'null', 'null', 'null', 0, 1.0),
+        (2, 'null', '/', 'true', 0, 1, 2, 0, 1.0),
+        (3, 'null', '/', 'false', 1, 1, 2, 0, 1.0),
+        (4, -1, '/', 'true', 'null', 1, 'null', 0, 1.0),
+        ])
+    conn.commit()
+    conn.close()
+    tq = tqDB(path)
+    assert(tq.version() == SCHEMA_VERSION)
+    assert(tq['select id, state, pid from tq order by id'] == [
+        (1, 'pending', None), (2, 'done', None),
+        (3, 'failed', None), (4, 'accident', -1)])
+    plan = tq['explain query plan select * from tq where (state = ?)'
+              ' order by pri desc, id', ('pending',)]
+    assert('tq_state_pri_id' in str(plan))
+
+def test_db_autoincrement(tmp_path):
+    tq = tqDB(os.path.join(tmp_path, 'test.db'))
+    t = Task(None, None, '/', 'true', None, None, None, 0, 1.0, 'pending')
+    assert(tq.insert_tasks([t, t]) == [1, 2])
+    tq('delete from tq where (id = ?)', (2,))
+    # ids are never reused
+    assert(tq.insert_tasks([t]) == [3])
+    assert(tq.insert_notes([Note(None, 3, 'test')]) == [1])
+
+def test_db_archive(tmp_path):
+    tq = tqDB(os.path.join(tmp_path, 'test.db'))
+    tq.insert_tasks([
+        Task(None, None, '/', 'true', 0, 1, 2, 0, 1.0, 'done'),
+        Task(None, None, '/', 'false', 1, 1, 5, 0, 1.0, 'failed'),
+        Task(None, None, '/', 'true', None, None, None, 0, 1.0, 'pending'),
+        ])
+    tq.insert_notes([Note(None, 1, 'first'), Note(None, 1, 'second'),
+                     Note(None, 3, 'third')])
+    assert(tq.archive(before=3) == 1)
+    assert(tq.archive() == 1)
+    assert([t.id for t in tq['tq']] == [3])
+    assert([n.note for n in tq['notes']] == ['third'])
+    archived = tq['archive']
+    assert([t.id for t in archived] == [1, 2])
+    assert(utils.unpacknotes(archived[0].notes) == ['first', 'second'])
+    assert(utils.unpacknotes(archived[1].notes) == [])
+
+def test_db_downsample(tmp_path):
+    tq = tqDB(os.path.join(tmp_path, 'test.db'))
+    tq.executemany('insert into samples values (?, ?, ?, ?, ?)',
+            [(1, t, t % 2, t, None) for t in range(0, 40, 5)])
+    # [0, 10) and [10, 20) are merged, [20, 30) is not complete before 25
+    assert(tq.downsample(25, 10) == 2)
+    assert(sorted(tq['samples'])[:2] == [Sample(1, 0, 0.5, 5, None),
+                                 Sample(1, 10, 0.5, 15, None)])
+    # merged buckets are left alone
+    assert(tq.downsample(25, 10) == 0)
+    assert(tq.downsample(25, 10, expire=20) == 0)
+    assert(sorted(x.time for x in tq['samples']) == [20, 25, 30, 35])
+
 if __name__ == '__main__':
     test_db('./test.db')
@@ -3,10 +3,180 @@ Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
 License: MIT/Expat
 '''
 
+import os
 from tasque.resources import *
+from tasque.cuda_selector import Card
 
 def test_virtual_resource():
     R = VirtualResource()
     R.canalloc(1.0)
     R.waitfor(1.0)
-    R.request(1.0)()
+    R.request(1, 0.6)
+    R.acquire[1]()
+    assert(R.canalloc(0.4))
+    assert(not R.canalloc(0.5))
+    R.release[1]()
+    assert(R.canalloc(1.0))
+
+class FakeCudaSelector:
+    def __init__(self, cards):
+        self.cards = cards
+    def getCards(self):
+        return self.cards
+    def availCards(self):
+        return [c for c in self.cards if c.memory_free >= 0.97 * c.memory_total]
+
+def test_vmem_resource():
+    R = VmemResource()
+    R.cusel = FakeCudaSelector([Card(0, 10000, 2000, 8000),
+                                Card(1, 10000, 0, 10000)])
+    R.refresh()
+    # several placements within one pass
+    for pid in (1, 2, 3):
+        assert(R.canalloc(4000))
+        R.request(pid, 4000)
+        R.acquire[pid]()
+    assert(sorted(R.book.values()) == [(0, 4000), (0, 4000), (1, 4000)])
+    # the card goes into the environment of the task, not of the daemon
+    assert(R.environ[3] == {'CUDA_VISIBLE_DEVICES': str(R.book[3][0])})
+    assert('CUDA_VISIBLE_DEVICES' not in os.environ)
+    assert(R.canalloc(6000))
+    assert(not R.canalloc(6001))
+    R.release[3]()
+    assert(3 not in R.environ)
+    assert(R.canalloc(10000))
+
+def test_reserve():
+    R = VirtualResource()
+    R.request(1, 0.5)
+    R.acquire[1]()
+    # a blocked task of 0.8 leaves 0.2 to backfill
+    R.reserve(-1, 0.8)
+    assert(R.canalloc(0.2) and not R.canalloc(0.21))
+    R.release[-1]()
+    assert(R.canalloc(0.5))
+    # less when some is already backfilled
+    R.request(2, 0.1)
+    R.acquire[2]()
+    R.reserve(-1, 0.8, backfilled=[2])
+    assert(R.canalloc(0.1) and not R.canalloc(0.11))
+    R.release[-1]()
+    R.release[2]()
+    R = VmemResource()
+    R.cusel = FakeCudaSelector([Card(0, 10000, 6000, 4000),
+                                Card(1, 10000, 3000, 7000)])
+    R.refresh()
+    R.reserve(-1, 9000)
+    assert(R.canalloc(4000))
+    assert(not R.canalloc(4001))
+    R.release[-1]()
+    assert(R.canalloc(7000))
+
+def test_composite_resource():
+    R = create('virtual,vmem')
+    assert(isinstance(R, CompositeResource))
+    R.kinds['vmem'].cusel = FakeCudaSelector([Card(0, 10000, 0, 10000),
+                                              Card(1, 10000, 0, 10000)])
+    R.refresh()
+    R.request(1, {'virtual': 0.5, 'vmem': 6000})
+    R.acquire[1]()
+    # best fit: the second task goes to the same card
+    R.request(2, {'virtual': 0.25, 'vmem': 4000})
+    R.acquire[2]()
+    assert(R.kinds['vmem'].book[1][0] == R.kinds['vmem'].book[2][0])
+    assert(R.canalloc({'virtual': 0.25, 'vmem': 10000}))
+    # every dimension has to fit
+    assert(not R.canalloc({'virtual': 0.5, 'vmem': 1000}))
+    assert(not R.canalloc({'cpu': 1}))
+    # scalar requests go to the first kind
+    assert(R.canalloc(0.25) and not R.canalloc(0.3))
+    R.release[1]()
+    assert(R.canalloc({'virtual': 0.75, 'vmem': 6000}))
+    assert(R.book == {2: {'virtual': 0.25, 'vmem': 4000}})
+
+def _sysfs(tmp_path):
+    # 2 NUMA nodes x 2 physical cores x 2 SMT threads
+    for cpu in range(8):
+        path = tmp_path / f'cpu{cpu}'
+        (path / 'topology').mkdir(parents=True)
+        (path / f'node{cpu // 4}').mkdir()
+        sib = cpu % 4 // 2 * 2 + cpu // 4 * 4
+        (path / 'topology' / 'thread_siblings_list').write_text(f'{sib}-{sib+1}\n')
+    return str(tmp_path)
+
+def test_cpu_resource(tmp_path):
+    R = CpuResource(cpus=range(8), sysfs=_sysfs(tmp_path))
+    assert(R.siblings[5] == (4, 5) and R.nodes[5] == 1)
+    R.request(1, 2)
+    # known before the task process is spawned, to be pinned from the start
+    assert(R.affinity[1] == [0, 1])
+    R.acquire[1]()
+    # a whole physical core
+    assert(R.book[1] == [0, 1])
+    # the tightest NUMA node, whole cores first
+    R.request(2, 1.5)
+    R.acquire[2]()
+    assert(R.book[2] == [2, 3])
+    R.request(3, 3)
+    R.acquire[3]()
+    assert(R.book[3] == [4, 5, 6])
+    assert(R.avail() == 1.0)
+    assert(R.canalloc(1) and not R.canalloc(2))
+    R.release[1]()
+    assert(R.canalloc(3) and 1 not in R.affinity)
+
+def test_cpu_resource_smt(tmp_path):
+    R = CpuResource(cpus=range(8), sysfs=_sysfs(tmp_path))
+    R.exclusive_smt = True
+    R.request(1, 1)
+    R.acquire[1]()
+    assert(R.book[1] == [0, 1])
+    R.request(2, 3)
+    R.acquire[2]()
+    assert(R.book[2] == [4, 5, 6, 7])
+    assert(R.canalloc(2) and not R.canalloc(3))
+
+def test_memory_resource(tmp_path):
+    meminfo = tmp_path / 'meminfo'
+    meminfo.write_text('MemTotal: 67108864 kB\nMemAvailable: 33554432 kB\n')
+    R = MemoryResource()
+    R.meminfo = str(meminfo)
+    rss = {1: 0., 2: 0.}
+    R._rss = lambda pid: rss[pid]
+    R.refresh()
+    assert(R.avail() == 32768.)
+    R.request(1, 30000)
+    R.acquire[1]()
+    assert(R.canalloc(2768) and not R.canalloc(2769))
+    # the task starts to use 2 GB: MemAvailable drops accordingly
+    rss[1] = 2048.
+    meminfo.write_text('MemTotal: 67108864 kB\nMemAvailable: 31457280 kB\n')
+    R.refresh()
+    assert(R.canalloc(2768) and not R.canalloc(2769))
+    # once settled, the reservation shrinks to margin * peak RSS
+    R.since[1] -= R.settle
+    R.refresh()
+    assert(R.book[1] == R.margin * 2048.)
+    assert(R.canalloc(30720 - 0.2 * 2048.))
+    R.release[1]()
+    assert(R.book == {} and R.since == {})
+
+def test_adopt():
+    import json
+    R = create('virtual,vmem')
+    R.kinds['vmem'].cusel = FakeCudaSelector([Card(0, 10000, 0, 10000),
+                                              Card(1, 10000, 0, 10000)])
+    R.refresh()
+    R.request(1, {'virtual': 0.5, 'vmem': 6000})
+    R.acquire[1]()
+    placement = json.loads(json.dumps(R.placement(1)))
+    # a restarted daemon books the same card again
+    S = create('virtual,vmem')
+    S.kinds['vmem'].cusel = R.kinds['vmem'].cusel
+    S.refresh()
+    S.adopt(1, 123, placement)
+    assert(S.book == R.book)
+    assert(S.kinds['vmem'].book == R.kinds['vmem'].book)
+    assert(not S.canalloc({'virtual': 0.6}))
+    S.release[1]()
+    assert(S.book == {} and S.kinds['vmem'].book == {})
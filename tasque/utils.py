@@ -3,10 +3,16 @@ Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
 License: MIT/Expat
 '''
 
+from typing import *
 import math
 import os
 import contextlib
 import fcntl
+import hashlib
+import json
+import re
+import socket
+import zstd
 
 
 @contextlib.contextmanager
@@ -42,6 +48,108 @@ def checkpid(pid: int) -> bool:
         return True
 
 
+def procstart(pid: int) -> int:
+    '''
+    Start time of a live process (clock ticks since boot, from /proc), which
+    tells it apart from a later process that reuses the pid. None if there
+    is no such process, or if it is a zombie.
+    '''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    if fields[0] in ('Z', 'X'):
+        return None
+    return int(fields[19])
+
+
+def notify(path: str, message: bytes = b'wakeup') -> bool:
+    '''
+    Send a datagram to the daemon listening on the unix socket <path>.
+    Does not block, and does nothing if the daemon is not running.
+    '''
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(message, path)
+    except OSError:
+        return False
+    else:
+        return True
+
+
+def cpulist(spec: str) -> list:
+    '''
+    Parse a cpu list in the sysfs format, e.g. "0-3,8,10-11".
+    '''
+    cpus = []
+    for part in spec.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def descendants(pid: int) -> list:
+    '''
+    PIDs of all the descendant processes of a given process, from /proc.
+    '''
+    children = dict()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # the command name may contain spaces and parentheses
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    result, todo = [], [pid]
+    while todo:
+        for child in children.get(todo.pop(), []):
+            result.append(child)
+            todo.append(child)
+    return result
+
+
+def proctree(pids: list) -> (float, float):
+    '''
+    Total CPU time (seconds, including waited-for children) and RSS (MB)
+    of a set of processes, from /proc. Vanished processes are skipped.
+    '''
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu, rss = 0, 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime, stime, cutime, cstime
+            cpu += sum(int(x) for x in fields[11:15])
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+                        break
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu / ticks, rss / 1024.
+
+
+def normcmd(cmd: str) -> str:
+    '''
+    Normalize a command line for matching similar tasks: whitespace is
+    collapsed and numbers are masked, so that runs only differing in e.g.
+    the random seed or the learning rate are considered alike.
+    '''
+    return re.sub(r'\d+(\.\d+)?', '#', ' '.join(cmd.split()))
+
+
 def null2none(T: tuple) -> tuple:
     '''
     We unify null values into None in the python domain.
@@ -54,3 +162,102 @@ def none2null(T: tuple) -> tuple:
     We unify none values into null in the SQL domain.
     '''
     return tuple(x if x is not None else 'null' for x in T)
+
+
+def retrycodes(codes: str) -> List[int]:
+    '''
+    Parse the exit codes of a retry policy, a comma-separated list such as
+    "1,137,-9". Raises ValueError on anything else.
+    '''
+    try:
+        return [int(x) for x in str(codes or '').split(',') if x.strip()]
+    except ValueError:
+        raise ValueError(f'invalid exit codes {codes!r}')
+
+
+def packnotes(notes: list) -> Optional[bytes]:
+    '''
+    Compress a list of note strings for the archive. Returns None (NULL in
+    the archive) when there is no note.
+    '''
+    if not notes:
+        return None
+    return zstd.compress(json.dumps(notes).encode())
+
+
+def unpacknotes(blob: bytes) -> list:
+    '''
+    Inverse of packnotes.
+    '''
+    if not blob:
+        return []
+    return json.loads(zstd.decompress(blob).decode())
+
+
+def zstdframes(data: bytes, start: int = 0) -> list:
+    '''
+    Locate the complete zstd frames in data[start:] by walking the frame
+    and block headers, without decompressing anything. Returns a list of
+    (begin, end) offsets. A truncated trailing frame (e.g. one being
+    written) is left out.
+    '''
+    frames, pos, n = [], start, len(data)
+    while pos + 4 <= n:
+        magic = int.from_bytes(data[pos:pos+4], 'little')
+        if magic & 0xFFFFFFF0 == 0x184D2A50:  # skippable frame
+            if pos + 8 > n:
+                break
+            end = pos + 8 + int.from_bytes(data[pos+4:pos+8], 'little')
+        elif magic == 0xFD2FB528:
+            if pos + 5 > n:
+                break
+            fhd = data[pos+4]
+            single = (fhd >> 5) & 1
+            fcs = (0 if not single else 1, 2, 4, 8)[fhd >> 6]
+            end = pos + 5 + (0 if single else 1) + (0, 1, 2, 4)[fhd & 3] + fcs
+            last = False
+            while not last and end + 3 <= n:
+                header = int.from_bytes(data[end:end+3], 'little')
+                last, btype, bsize = header & 1, (header >> 1) & 3, header >> 3
+                end += 3 + (1 if btype == 1 else bsize)
+            if not last:
+                break
+            end += 4 if (fhd >> 2) & 1 else 0
+        else:
+            raise ValueError(f'not a zstd frame at offset {pos}')
+        if end > n:
+            break
+        frames.append((pos, end))
+        pos = end
+    return frames
+
+
+def zstdsize(data: bytes) -> int:
+    '''
+    Total decompressed size of the complete zstd frames in data (see
+    zstdframes), from the frame headers when they tell it.
+    '''
+    total = 0
+    for (begin, end) in zstdframes(data):
+        if int.from_bytes(data[begin:begin+4], 'little') != 0xFD2FB528:
+            continue  # skippable frame
+        fhd = data[begin+4]
+        single = (fhd >> 5) & 1
+        fcs = (0 if not single else 1, 2, 4, 8)[fhd >> 6]
+        if fcs == 0:
+            total += len(zstd.decompress(data[begin:end]))
+            continue
+        pos = begin + 5 + (0 if single else 1) + (0, 1, 2, 4)[fhd & 3]
+        total += int.from_bytes(data[pos:pos+fcs], 'little') + (256 if fcs == 2 else 0)
+    return total
+
+
+def filehash(path: str, chunk: int = 1 << 20) -> str:
+    '''
+    sha256 hex digest of the content of a file.
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
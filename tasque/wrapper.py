@@ -0,0 +1,91 @@
+'''
+Copyright (C) 2016-2021 Mo Zhou <lumin@debian.org>
+License: MIT/Expat
+
+A small parent process for command line tasks, so that their exit status is
+known even when the daemon is not around (e.g. across a restart): it spawns
+the command, waits for it, and writes the wait status and rusage into a
+status file before exiting the same way. Signals (e.g. SIGTERM from tq kill)
+are forwarded to the command. With --cpus, the command is pinned to these
+cores from the start (see resources.CpuResource).
+
+It is run as a plain script (python -I -S wrapper.py [--cpus 0,1]
+<status> <cmd ...>), so it only depends on the standard library, to start
+fast.
+
+The status file is json: {"status": ..., "rusage": {...}}, the same for the
+python tasks, whose template process writes it (see forkserver).
+'''
+
+import json
+import os
+import resource
+import signal
+import sys
+import types
+
+_RUSAGE = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock', 'ru_oublock',
+        'ru_nvcsw', 'ru_nivcsw')
+_FORWARD = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT,
+        signal.SIGUSR1, signal.SIGUSR2)
+
+
+def writestatus(path: str, status: int, ru: object) -> None:
+    '''
+    Record the exit status of a task into <path>, atomically.
+    '''
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(status=status,
+            rusage={k: getattr(ru, k) for k in _RUSAGE}), f)
+    os.replace(tmp, path)
+
+
+def readstatus(path: str) -> (int, object):
+    '''
+    The (wait status, rusage) recorded in <path>, or (None, None).
+    '''
+    try:
+        with open(path) as f:
+            record = json.load(f)
+        return record['status'], types.SimpleNamespace(**record['rusage'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+
+def main(argv: list) -> None:
+    '''
+    argv: [--cpus <comma-separated cores>] <status file> <command> [args ...]
+    '''
+    if argv[:1] == ['--cpus']:
+        # inherited by the command and all of its threads
+        os.sched_setaffinity(0, [int(x) for x in argv[1].split(',')])
+        argv = argv[2:]
+    path, cmd = argv[0], argv[1:]
+    child = []
+    def forward(signo, frame):
+        for pid in child:
+            os.kill(pid, signo)
+    for signo in _FORWARD:
+        signal.signal(signo, forward)
+    try:
+        child.append(os.posix_spawnp(cmd[0], cmd, os.environ,
+            setsigdef=_FORWARD))
+    except (OSError, IndexError) as e:
+        print(f'tasque: cannot run {cmd}: {e}', file=sys.stderr, flush=True)
+        status = 127 << 8
+        writestatus(path, status, resource.getrusage(resource.RUSAGE_SELF))
+        os._exit(127)
+    _, status, ru = os.wait4(child[0], 0)
+    writestatus(path, status, ru)
+    # exit the same way, so that our parent sees the same status
+    if os.WIFSIGNALED(status):
+        signo = os.WTERMSIG(status)
+        signal.signal(signo, signal.SIG_DFL)
+        os.kill(os.getpid(), signo)
+        os._exit(128 + signo)
+    os._exit(os.waitstatus_to_exitcode(status) & 0xff)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])